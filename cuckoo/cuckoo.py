@@ -1,18 +1,19 @@
-import io
 import json
+import orjson
 import os
 import tarfile
-import random
 from json import JSONDecodeError
 import ssdeep
 import hashlib
-from pefile import PE, PEFormatError
 import re
+import secrets
 import email.header
 import sys
 import requests
 import tempfile
-from threading import Thread
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
 
 from retrying import retry, RetryError
 
@@ -35,6 +36,11 @@ HOLLOWSHUNTER_DUMP_REGEX = "hollowshunter\/hh_process_[0-9]{3,}_[a-zA-Z0-9]*\.*[
 HOLLOWSHUNTER_EXE_REGEX = "hollowshunter\/hh_process_[0-9]{3,}_[a-zA-Z0-9]*\.*[a-zA-Z0-9]+\.exe$"
 HOLLOWSHUNTER_SHC_REGEX = "hollowshunter\/hh_process_[0-9]{3,}_[a-zA-Z0-9]*\.*[a-zA-Z0-9]+\.shc$"
 HOLLOWSHUNTER_DLL_REGEX = "hollowshunter\/hh_process_[0-9]{3,}_[a-zA-Z0-9]*\.*[a-zA-Z0-9]+\.dll$"
+HOLLOWSHUNTER_REPORT_PATTERN = re.compile(HOLLOWSHUNTER_REPORT_REGEX)
+HOLLOWSHUNTER_DUMP_PATTERN = re.compile(HOLLOWSHUNTER_DUMP_REGEX)
+HOLLOWSHUNTER_EXE_PATTERN = re.compile(HOLLOWSHUNTER_EXE_REGEX)
+HOLLOWSHUNTER_SHC_PATTERN = re.compile(HOLLOWSHUNTER_SHC_REGEX)
+HOLLOWSHUNTER_DLL_PATTERN = re.compile(HOLLOWSHUNTER_DLL_REGEX)
 
 CUCKOO_API_SUBMIT = "tasks/create/file"
 CUCKOO_API_QUERY_TASK = "tasks/view/%s"
@@ -48,6 +54,30 @@ CUCKOO_POLL_DELAY = 5
 GUEST_VM_START_TIMEOUT = 360  # Give the VM at least 6 minutes to start up
 REPORT_GENERATION_TIMEOUT = 300  # Give the analysis at least 5 minutes to generate the report
 ANALYSIS_TIMEOUT = 150
+MACHINES_CACHE_TTL = 60  # The machines available in the Cuckoo nest rarely change, so they are only queried once a minute
+
+# The delay between two polls of a task grows exponentially (1s, 2s, 4s, ...) up to CUCKOO_POLL_BACKOFF_MAX seconds,
+# with up to CUCKOO_POLL_JITTER seconds of random delay added. The timeouts above are the deadlines for polling.
+CUCKOO_POLL_BACKOFF_MULTIPLIER = 500  # In milliseconds, doubled by retrying on the first attempt
+CUCKOO_POLL_BACKOFF_MAX = 30
+CUCKOO_POLL_JITTER = 0.5
+
+# One-off requests that are retried back off the same way, starting from a shorter delay, so that several service
+# instances retrying against the same Cuckoo nest do not all hit it at once
+CUCKOO_RETRY_BACKOFF_MULTIPLIER = 250  # In milliseconds
+CUCKOO_RETRY_BACKOFF_MAX = 5
+CUCKOO_RETRY_JITTER = 0.5
+
+# Connection pool sizing for the session shared by every request made to the Cuckoo REST API
+CUCKOO_POOL_CONNECTIONS = 8
+CUCKOO_POOL_MAXSIZE = 16
+
+# Size of the buffer used when streaming a report archive from the Cuckoo REST API to disk
+REPORT_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Length of the common substring that ssdeep requires before it will score two signatures
+SSDEEP_GRAM_LENGTH = 7
+SSDEEP_REPEATED_CHARS_PATTERN = re.compile(r"(.)\1{3,}")
 
 LINUX_IMAGE_PREFIX = "ub"
 WINDOWS_IMAGE_PREFIX = "win"
@@ -56,12 +86,13 @@ x64_IMAGE_SUFFIX = "x64"
 RELEVANT_IMAGE_TAG = "auto"
 ALL_IMAGES_TAG = "all"
 MACHINE_NAME_REGEX = f"(?:{('|').join([LINUX_IMAGE_PREFIX, WINDOWS_IMAGE_PREFIX])})(.*)(?:{('|').join([x64_IMAGE_SUFFIX, x86_IMAGE_SUFFIX])})"
+MACHINE_NAME_PATTERN = re.compile(MACHINE_NAME_REGEX)
 
 LINUX_FILES = [file_type for file_type in RECOGNIZED_TYPES if "linux" in file_type]
 WINDOWS_x86_FILES = [file_type for file_type in RECOGNIZED_TYPES if all(val in file_type for val in ["windows", "32"])]
 
 # TODO: is this necessary?
-SUPPORTED_EXTENSIONS = [
+SUPPORTED_EXTENSIONS = frozenset([
     "cpl",
     "dll",
     "exe",
@@ -104,9 +135,10 @@ SUPPORTED_EXTENSIONS = [
     "lnk",
     "hwp",
     "pub",
-]
+])
 
 ILLEGAL_FILENAME_CHARS = set('<>:"/\|?*')
+MIME_ENCODED_FILE_NAME_PATTERN = re.compile(r"^=\?.*\?=$")
 
 # Enumeration for statuses
 TASK_MISSING = "missing"
@@ -121,6 +153,11 @@ TASK_COMPLETED = "completed"
 TASK_REPORTED = "reported"
 ANALYSIS_FAILED = "analysis_failed"
 
+# Statuses that Cuckoo gives a task once it has failed to analyze, process or report on it
+TASK_FAILED_STATUSES = frozenset({"failed_analysis", "failed_processing", "failed_reporting"})
+# Statuses that Cuckoo gives a task once the analysis has started, after which errors are no longer fatal
+TASK_STARTED_STATUSES = frozenset({"running", TASK_COMPLETED, TASK_REPORTED})
+
 
 class CuckooTimeoutException(Exception):
     """Exception class for timeouts"""
@@ -152,6 +189,11 @@ class ReportSizeExceeded(Exception):
     pass
 
 
+class DownloadAborted(Exception):
+    """Exception class for downloads that were stopped before they finished"""
+    pass
+
+
 def _exclude_chain_ex(ex):
     """Use this with some of the @retry decorators to only retry if the exception
     ISN'T a RecoverableException or NonRecoverableException"""
@@ -201,6 +243,43 @@ class SubmissionThread(Thread):
         return self.ret
 
 
+class SsdeepIndex:
+    # ssdeep only scores two hashes above 0 if their block sizes are equal or one is double the other, and if the
+    # signatures compared at a shared block size have a substring of SSDEEP_GRAM_LENGTH in common (after runs of more
+    # than three identical characters are collapsed). Indexing every such substring by its block size means that a
+    # new hash is only compared against the hashes it could possibly match, instead of against every hash seen so far.
+    def __init__(self):
+        self.hashes = set()
+        self.grams = {}
+
+    @staticmethod
+    def _keys(ssdeep_hash):
+        block_size, chunk, double_chunk = ssdeep_hash.split(":", 2)
+        block_size = int(block_size)
+        keys = set()
+        for size, signature in [(block_size, chunk), (block_size * 2, double_chunk)]:
+            signature = SSDEEP_REPEATED_CHARS_PATTERN.sub(r"\1\1\1", signature)
+            for i in range(len(signature) - SSDEEP_GRAM_LENGTH + 1):
+                keys.add((size, signature[i:i + SSDEEP_GRAM_LENGTH]))
+        return keys
+
+    def add(self, ssdeep_hash):
+        if ssdeep_hash in self.hashes:
+            return
+        self.hashes.add(ssdeep_hash)
+        for key in self._keys(ssdeep_hash):
+            self.grams.setdefault(key, set()).add(ssdeep_hash)
+
+    def has_match(self, ssdeep_hash, match_pct):
+        # Identical hashes always score 100, even when they are too short to share a substring
+        if ssdeep_hash in self.hashes:
+            return True
+        candidates = set()
+        for key in self._keys(ssdeep_hash):
+            candidates.update(self.grams.get(key, ()))
+        return any(ssdeep.compare(ssdeep_hash, candidate) >= match_pct for candidate in candidates)
+
+
 # noinspection PyBroadException
 # noinspection PyGlobalUndefined
 class Cuckoo(ServiceBase):
@@ -220,6 +299,8 @@ class Cuckoo(ServiceBase):
         self.session = None
         self.ssdeep_match_pct = None
         self.machines = None
+        self.machines_by_name = {}
+        self.machines_cache = (None, 0.0, None)
         self.auth_header = None
         self.timeout = None
         self.max_report_size = None
@@ -242,18 +323,22 @@ class Cuckoo(ServiceBase):
         self.timeout = 120  # arbitrary number, not too big, not too small
         self.max_report_size = self.config.get('max_report_size', 275000000)
         self.allowed_images = self.config.get("allowed_images", [])
+        # orjson does not recurse when parsing reports, but building the process trees of deep reports still does. The
+        # limit is raised once for the lifetime of the service, rather than again for every report
+        sys.setrecursionlimit(int(self.config['recursion_limit']))
+
+        # A single session is kept for the lifetime of the service so that connections to the Cuckoo nest are reused
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=CUCKOO_POOL_CONNECTIONS,
+                                                pool_maxsize=CUCKOO_POOL_MAXSIZE, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(self.auth_header)
         self.log.debug("Cuckoo started!")
 
     # noinspection PyTypeChecker
     def execute(self, request: ServiceRequest):
         self.request = request
-        self.session = requests.Session()
-        self.set_urls()
         request.result = Result()
-
-        # Setting working directory for request
-        request._working_directory = self.working_directory
-
         self.file_res = request.result
 
         # Poorly name var to track keyword arguments to pass into cuckoo's 'submit' function
@@ -265,10 +350,15 @@ class Cuckoo(ServiceBase):
         self._remove_illegal_characters_from_file_name()
         file_ext = self._assign_file_extension(kwargs)
         if file_ext is None:
-            # File extension or bust!
+            # File extension or bust! Nothing above this point creates files or reaches out to the Cuckoo nest.
             return
 
-        self.machines = self.query_machines()
+        self.set_urls()
+
+        # Setting working directory for request
+        request._working_directory = self.working_directory
+
+        self.machines = self._get_machines()
 
         machine_requested, machine_exists = self._handle_specific_machine(kwargs)
         if machine_requested and not machine_exists:
@@ -327,17 +417,14 @@ class Cuckoo(ServiceBase):
                 self._generate_report(file_ext, cuckoo_task, parent_section)
 
         except RecoverableError:
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise
         except Exception as e:
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise Exception(e)
 
         # Delete and exit
-        if cuckoo_task and cuckoo_task.id is not None:
-            self.delete_task(cuckoo_task)
+        self._safely_delete_task(cuckoo_task)
 
     def submit(self, file_content, cuckoo_task, parent_section):
         try:
@@ -353,26 +440,18 @@ class Cuckoo(ServiceBase):
             err_msg = f"Error submitting to Cuckoo: {safe_str(e)}"
             self.log.error(err_msg)
             # TODO: could this ever happen?
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise Exception(err_msg)
 
         self.log.debug(f"Submission succeeded. File: {cuckoo_task.file} -- Task ID: {cuckoo_task.id}")
 
         try:
-            status = self.poll_started(cuckoo_task)
+            status = self.poll_task(cuckoo_task, parent_section)
         except RetryError:
-            self.log.error(f"VM startup timed out or {cuckoo_task.id} was never added to the Cuckoo DB.")
+            self.log.error(f"Max retries exceeded for task {cuckoo_task.id}. Either the VM startup timed out, the task "
+                           f"was never added to the Cuckoo DB or the report was never generated.")
             status = None
 
-        # TODO: if status != TASK_STARTED, but still exists, then the rest of the function does nothing
-        if status == TASK_STARTED:
-            try:
-                status = self.poll_report(cuckoo_task, parent_section)
-            except RetryError:
-                self.log.error("Max retries exceeded for report status.")
-                status = None
-
         err_msg = None
         # TODO: Turn this into a map?
         if status is None:
@@ -383,14 +462,13 @@ class Cuckoo(ServiceBase):
             err_msg = "Service has been stopped while waiting for Cuckoo to analyze file."
         # TODO: why even check then?
         elif status == INVALID_JSON:
-            # This has already been handled in poll_report
+            # This has already been handled in poll_task
             pass
         elif status == REPORT_TOO_BIG:
-            # This has already been handled in poll_report
+            # This has already been handled in poll_task
             pass
         elif status == SERVICE_CONTAINER_DISCONNECTED:
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise Exception("The service container has closed the pipe after making an "
                             "API request, most likely due to lack of disk space.")
         elif status == MISSING_REPORT:
@@ -398,28 +476,35 @@ class Cuckoo(ServiceBase):
             raise RecoverableError(f"Retrying after {MISSING_REPORT} status")
         elif status == ANALYSIS_FAILED:
             task_id = cuckoo_task.id
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise Exception(f"The analysis of #{task_id} has failed. This is most likely because a non-native "
                             f"file type was attempted to be detonated. Example: .dll on a Linux VM.")
 
         if err_msg:
             self.log.error(f"Error is: {err_msg}")
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise RecoverableError(err_msg)
 
     def stop(self):
         # Need to kill the container; we're about to go down..
         self.log.info("Service is being stopped; removing all running containers and metadata..")
+        # Return the pooled connections to the Cuckoo nest
+        if self.session is not None:
+            self.session.close()
+            self.session = None
 
-    # TODO: stop_max_attempt_number should be GUEST_VM_START_TIMEOUT / CUCKOO_POLL_DELAY
-    @retry(wait_fixed=CUCKOO_POLL_DELAY * 1000,
-           stop_max_attempt_number=(GUEST_VM_START_TIMEOUT/CUCKOO_POLL_DELAY),
-           retry_on_result=_retry_on_none)
-    def poll_started(self, cuckoo_task):
+    # TODO: do we need retry_on_exception?
+    @retry(wait_exponential_multiplier=CUCKOO_POLL_BACKOFF_MULTIPLIER,
+           wait_exponential_max=CUCKOO_POLL_BACKOFF_MAX * 1000,
+           wait_jitter_max=int(CUCKOO_POLL_JITTER * 1000),
+           stop_max_delay=(GUEST_VM_START_TIMEOUT + REPORT_GENERATION_TIMEOUT) * 1000,
+           stop_max_attempt_number=((GUEST_VM_START_TIMEOUT + REPORT_GENERATION_TIMEOUT)/CUCKOO_POLL_DELAY),
+           retry_on_result=_retry_on_none,
+           retry_on_exception=_exclude_chain_ex)
+    def poll_task(self, cuckoo_task, parent_section):
+        # A single poller follows the task from the guest VM starting up until the report has been generated
         task_info = self.query_task(cuckoo_task)
-        if task_info is None:
+        if task_info is None or task_info == {}:
             # The API didn't return a task..
             return TASK_MISSING
 
@@ -428,44 +513,27 @@ class Cuckoo(ServiceBase):
             self.log.warning(f"Cuckoo returned mismatched task info for task: {cuckoo_task.id}. Trying again..")
             return None
 
+        # The guest VM is still starting up, or the task hasn't been added to the Cuckoo DB yet
         if task_info.get("guest", {}).get("status") == TASK_STARTING:
             return None
 
         if task_info.get("task", {}).get("status") == TASK_MISSING:
             return None
 
+        # Check for errors first to avoid parsing exceptions
+        status = task_info.get("status", "")
+        if status in TASK_FAILED_STATUSES:
+            self.log.error(f"Analysis has failed for #{cuckoo_task.id} due to {task_info.get('errors', [])}.")
+            return ANALYSIS_FAILED
+
+        # Until the analysis has started, errors mean the task is not ready yet
         errors = task_info.get("errors", [])
-        if len(errors) > 0:
+        if status not in TASK_STARTED_STATUSES and len(errors) > 0:
             for error in errors:
                 self.log.error(error)
             return None
 
-        return TASK_STARTED
-
-    # TODO: stop_max_attempt_number definitely should be used, otherwise a container could run until it hits the preempt limit
-    # TODO: Its value should be x such that x / CUCKOO_POLL_DELAY = 5(?) minutes or 300 seconds
-    # TODO: do we need retry_on_exception?
-    @retry(wait_fixed=CUCKOO_POLL_DELAY * 1000,
-           stop_max_attempt_number=(REPORT_GENERATION_TIMEOUT/CUCKOO_POLL_DELAY),
-           retry_on_result=_retry_on_none,
-           retry_on_exception=_exclude_chain_ex)
-    def poll_report(self, cuckoo_task, parent_section):
-        task_info = self.query_task(cuckoo_task)
-        if task_info is None or task_info == {}:
-            # The API didn't return a task..
-            return TASK_MISSING
-
-        # Detect if mismatch
-        if task_info["id"] != cuckoo_task.id:
-            self.log.warning(f"Cuckoo returned mismatched task info for task: {cuckoo_task.id}. Trying again..")
-            return None
-
-        # Check for errors first to avoid parsing exceptions
-        status = task_info["status"]
-        if "fail" in status:
-            self.log.error(f"Analysis has failed for #{cuckoo_task.id} due to {task_info['errors']}.")
-            return ANALYSIS_FAILED
-        elif status == TASK_COMPLETED:
+        if status == TASK_COMPLETED:
             self.log.debug(f"Analysis has completed for #{cuckoo_task.id}, waiting on report to be produced.")
         elif status == TASK_REPORTED:
             self.log.debug(f"Cuckoo report generation has completed for {cuckoo_task.id}.")
@@ -506,21 +574,19 @@ class Cuckoo(ServiceBase):
         self.log.debug(f"Submitting file: {cuckoo_task.file} to server {self.submit_url}")
         files = {"file": (cuckoo_task.file, file_content)}
         try:
-            resp = self.session.post(self.submit_url, files=files, data=cuckoo_task, headers=self.auth_header, timeout=self.timeout)
+            resp = self.session.post(self.submit_url, files=files, data=cuckoo_task, timeout=self.timeout)
         except requests.exceptions.Timeout:
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise CuckooTimeoutException(f"Cuckoo ({self.base_url}) timed out after {self.timeout}s while "
                                          f"trying to submit a file {cuckoo_task.file}")
         except requests.ConnectionError:
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise Exception(f"Unable to reach the Cuckoo nest while trying to submit a file {cuckoo_task.file}")
         if resp.status_code != 200:
             self.log.error(f"Failed to submit file {cuckoo_task.file}. Status code: {resp.status_code}")
 
             if resp.status_code == 500:
-                new_filename = generate_random_words(1)
+                new_filename = secrets.token_hex(4)
                 file_ext = cuckoo_task.file.rsplit(".", 1)[-1]
                 cuckoo_task.file = new_filename + "." + file_ext
                 self.log.error(f"Got 500 error from Cuckoo API. This is often caused by non-ascii filenames. "
@@ -529,7 +595,7 @@ class Cuckoo(ServiceBase):
                 raise RecoverableError("Retrying after 500 error")
             return None
         else:
-            resp_dict = dict(resp.json())
+            resp_dict = resp.json()
             task_id = resp_dict["task_id"]
             # TODO: does this ever happen?
             if not task_id:
@@ -541,13 +607,14 @@ class Cuckoo(ServiceBase):
                     return None
             return task_id
 
-    def query_report(self, cuckoo_task, fmt="json", params=None):
+    def query_report(self, cuckoo_task, fmt="json", params=None, output_path=None, delete_task_on_error=True,
+                     abort_event=None):
         self.log.debug(f"Querying report, task_id: {cuckoo_task.id} - format: {fmt}")
         try:
             # There are edge cases that require us to stream the report to disk
             temp_report = tempfile.SpooledTemporaryFile()
             with self.session.get(self.query_report_url % cuckoo_task.id + '/' + fmt, params=params or {},
-                                  headers=self.auth_header, timeout=self.timeout, stream=True) as resp:
+                                  timeout=self.timeout, stream=True) as resp:
                 if int(resp.headers["Content-Length"]) > self.max_report_size:
                     # BAIL, TOO BIG and there is a strong chance it will crash the Docker container
                     resp.status_code = 413  # Request Entity Too Large
@@ -555,24 +622,27 @@ class Cuckoo(ServiceBase):
                     # We just want to confirm that the report.json has been created. We will extract it later
                     # when we call for the tar ball
                     pass
+                elif output_path and resp.status_code == 200:
+                    # Large archives are written straight to disk rather than being held in memory
+                    self._write_response_to_file(resp, output_path, abort_event)
                 # TODO: if fmt is acceptable and resp.status_code is 200, then we should write. not if else. if else, then raise?
                 else:
                     for chunk in resp.iter_content(chunk_size=8192):
                         temp_report.write(chunk)
         except requests.exceptions.Timeout:
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            if delete_task_on_error:
+                self._safely_delete_task(cuckoo_task)
             raise CuckooTimeoutException(f"Cuckoo ({self.base_url}) timed out after {self.timeout}s while trying to "
                                          f"query the report for task {cuckoo_task.id}")
-        except requests.ConnectionError:
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
             raise Exception(f"Unable to reach the Cuckoo nest while trying to query the report for task {cuckoo_task.id}")
         if resp.status_code != 200:
             if resp.status_code == 404:
                 self.log.error(f"Task or report not found for task {cuckoo_task.id}.")
                 # most common cause of getting to here seems to be odd/non-ascii filenames, where the cuckoo agent
                 # inside the VM dies
-                if cuckoo_task and cuckoo_task.id is not None:
-                    self.delete_task(cuckoo_task)
+                if delete_task_on_error:
+                    self._safely_delete_task(cuckoo_task)
                 raise MissingCuckooReportException("Task or report not found")
             elif resp.status_code == 413:
                 msg = f"Cuckoo report (type={fmt}) size is {int(resp.headers['Content-Length'])} for task #{cuckoo_task.id} which is bigger than the allowed size of {self.max_report_size}"
@@ -587,6 +657,9 @@ class Cuckoo(ServiceBase):
         try:
             if fmt == "json":
                 report_data = "exists"
+            elif output_path:
+                # The path to the report on disk is returned, if anything was written to it
+                report_data = output_path if os.path.getsize(output_path) else None
             else:
                 # Setting the pointer in the temp file
                 temp_report.seek(0)
@@ -598,40 +671,63 @@ class Cuckoo(ServiceBase):
 
         # TODO: report_data = b'{}' and b'""' evaluates to true, so that should be added to this check
         if not report_data or report_data == '':
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            if delete_task_on_error:
+                self._safely_delete_task(cuckoo_task)
             raise Exception("Empty report data")
 
         return report_data
 
+    @staticmethod
+    def _write_response_to_file(resp, output_path, abort_event=None):
+        # iter_content turns errors raised mid-download into requests exceptions, and a partially written file is
+        # removed so that it is never mistaken for a complete one. Setting abort_event stops the download early
+        try:
+            with open(output_path, "wb") as output_file:
+                for chunk in resp.iter_content(chunk_size=REPORT_STREAM_CHUNK_SIZE):
+                    if abort_event is not None and abort_event.is_set():
+                        raise DownloadAborted(f"Download to {output_path} was aborted")
+                    output_file.write(chunk)
+        except Exception:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise
+
     # TODO: This is dead service code for the Assemblyline team's Cuckoo setup, but may prove useful to others.
     #@retry(wait_fixed=2000)
-    def query_pcap(self, cuckoo_task):
+    def query_pcap(self, cuckoo_task, output_path=None):
         try:
-            resp = self.session.get(self.query_pcap_url % cuckoo_task.id, headers=self.auth_header, timeout=self.timeout)
+            resp = self.session.get(self.query_pcap_url % cuckoo_task.id, timeout=self.timeout,
+                                    stream=output_path is not None)
         except requests.exceptions.Timeout:
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
-            raise CuckooTimeoutException(f"Cuckoo ({self.base_url}) timed out after {self.timeout}s while trying to query the pcap for task %s" % cuckoo_task.id)
+            self._safely_delete_task(cuckoo_task)
+            raise CuckooTimeoutException(f"Cuckoo ({self.base_url}) timed out after {self.timeout}s while trying to query the pcap for task {cuckoo_task.id}")
         except requests.ConnectionError:
-            raise Exception("Unable to reach the Cuckoo nest while trying to query the pcap for task %s" % cuckoo_task.id)
+            raise Exception(f"Unable to reach the Cuckoo nest while trying to query the pcap for task {cuckoo_task.id}")
         pcap_data = None
-        if resp.status_code != 200:
-            if resp.status_code == 404:
-                self.log.error("Task or pcap not found for task: %s" % cuckoo_task.id)
+        with resp:
+            if resp.status_code != 200:
+                if resp.status_code == 404:
+                    self.log.error(f"Task or pcap not found for task: {cuckoo_task.id}")
+                else:
+                    self.log.error(f"Failed to query pcap for task {cuckoo_task.id}. Status code: {resp.status_code}")
+            elif output_path:
+                # The pcap can be hundreds of MB, so it is written straight to disk rather than being held in memory.
+                # The path to it is returned, if anything was written to it
+                try:
+                    self._write_response_to_file(resp, output_path)
+                except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                    raise Exception(f"Unable to reach the Cuckoo nest while trying to query the pcap for task {cuckoo_task.id}")
+                pcap_data = output_path if os.path.getsize(output_path) else None
             else:
-                self.log.error("Failed to query pcap for task %s. Status code: %d" % (cuckoo_task.id, resp.status_code))
-        else:
-            pcap_data = resp.content
+                pcap_data = resp.content
         return pcap_data
 
     # TODO: Validate that task_id is not None
     def query_task(self, cuckoo_task):
         try:
-            resp = self.session.get(self.query_task_url % cuckoo_task.id, headers=self.auth_header, timeout=self.timeout)
+            resp = self.session.get(self.query_task_url % cuckoo_task.id, timeout=self.timeout)
         except requests.exceptions.Timeout:
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise CuckooTimeoutException(f"({self.base_url}) timed out after {self.timeout}s while "
                                          f"trying to query the task {cuckoo_task.id}")
         except requests.ConnectionError:
@@ -646,7 +742,7 @@ class Cuckoo(ServiceBase):
             else:
                 self.log.error(f"Failed to query task {cuckoo_task.id}. Status code: {resp.status_code}")
         else:
-            resp_dict = dict(resp.json())
+            resp_dict = resp.json()
             task_dict = resp_dict['task']
             if task_dict is None or task_dict == '':
                 self.log.error('Failed to query task. Returned task dictionary is None or empty')
@@ -657,10 +753,9 @@ class Cuckoo(ServiceBase):
     # @retry(wait_fixed=2000)
     def query_machine_info(self, machine_name, cuckoo_task):
         try:
-            resp = self.session.get(self.query_machine_info_url % machine_name, headers=self.auth_header, timeout=self.timeout)
+            resp = self.session.get(self.query_machine_info_url % machine_name, timeout=self.timeout)
         except requests.exceptions.Timeout:
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise CuckooTimeoutException(f"({self.base_url}) timed out after {self.timeout}s while trying to query "
                                          f"machine info for {machine_name}")
         except requests.ConnectionError:
@@ -669,15 +764,18 @@ class Cuckoo(ServiceBase):
         if resp.status_code != 200:
             self.log.error(f"Failed to query machine {machine_name}. Status code: {resp.status_code}")
         else:
-            resp_dict = dict(resp.json())
+            resp_dict = resp.json()
             machine_dict = resp_dict['machine']
         return machine_dict
 
     # TODO: cuckoo_task.id should be set to None each time, no?
-    @retry(wait_fixed=CUCKOO_POLL_DELAY * 1000, stop_max_attempt_number=2)
+    @retry(wait_exponential_multiplier=CUCKOO_RETRY_BACKOFF_MULTIPLIER,
+           wait_exponential_max=CUCKOO_RETRY_BACKOFF_MAX * 1000,
+           wait_jitter_max=int(CUCKOO_RETRY_JITTER * 1000),
+           stop_max_attempt_number=2)
     def delete_task(self, cuckoo_task):
         try:
-            resp = self.session.get(self.delete_task_url % cuckoo_task.id, headers=self.auth_header, timeout=self.timeout)
+            resp = self.session.get(self.delete_task_url % cuckoo_task.id, timeout=self.timeout)
         except requests.exceptions.Timeout:
             raise CuckooTimeoutException(f"Cuckoo ({self.base_url}) timed out after {self.timeout}s while "
                                          f"trying to delete task {cuckoo_task.id}")
@@ -692,11 +790,16 @@ class Cuckoo(ServiceBase):
             if cuckoo_task:
                 cuckoo_task.id = None
 
+    def _safely_delete_task(self, cuckoo_task):
+        # Only tasks that made it to the Cuckoo nest have something to delete
+        if cuckoo_task and cuckoo_task.id is not None:
+            self.delete_task(cuckoo_task)
+
     # TODO: Validate params required for request, figure out how to test two requests exceptions
     def query_machines(self):
         self.log.debug(f"Querying for available analysis machines using url {self.query_machines_url}..")
         try:
-            resp = self.session.get(self.query_machines_url, headers=self.auth_header)
+            resp = self.session.get(self.query_machines_url, timeout=self.timeout)
         except requests.exceptions.Timeout:
             raise CuckooTimeoutException(f"Cuckoo ({self.base_url}) timed out after {self.timeout}s while trying to query machines")
         except requests.ConnectionError:
@@ -706,56 +809,79 @@ class Cuckoo(ServiceBase):
         if resp.status_code != 200:
             self.log.error(f"Failed to query machines: {resp.status_code}")
             raise CuckooVMBusyException(f"Failed to query machines: {resp.status_code}")
-        resp_dict = dict(resp.json())
+        resp_dict = resp.json()
         return resp_dict
 
-    def check_dropped(self, request, cuckoo_task, parent_section):
-        dropped_tar_bytes = self.query_report(cuckoo_task, 'dropped')
-        added_hashes = set()
+    def _get_machines(self):
+        # The cache is keyed on the url of the nest, and holds the time at which the machines were queried
+        cached_base_url, cached_time, cached_machines = self.machines_cache
+        now = time.monotonic()
+        if cached_machines is not None and cached_base_url == self.base_url and now - cached_time < MACHINES_CACHE_TTL:
+            return cached_machines
+
+        try:
+            machines = self.query_machines()
+        except Exception:
+            # Do not serve machines from a nest that we cannot reach anymore
+            self.machines_cache = (None, 0.0, None)
+            self.machines_by_name = {}
+            raise
+        self.machines_cache = (self.base_url, now, machines)
+        # Index the machines by name once per query, rather than scanning them whenever a machine is looked up
+        self.machines_by_name = {machine["name"]: machine for machine in machines.get("machines", [])}
+        return machines
+
+    def check_dropped(self, request, cuckoo_task, parent_section, dropped_tar_path):
+        added_hashes = SsdeepIndex()
         dropped_sec = None
         task_dir = os.path.join(self.working_directory, f"{cuckoo_task.id}")
-        if dropped_tar_bytes is not None:
+        if dropped_tar_path is not None:
             try:
-                dropped_tar = tarfile.open(fileobj=io.BytesIO(dropped_tar_bytes))
-                for tarobj in dropped_tar:
-                    if tarobj.isfile() and not tarobj.isdir():  # a file, not a dir
-                        # A dropped file found
-                        dropped_name = os.path.split(tarobj.name)[1]
-                        # Fixup the name.. the tar originally has files/your/file/path
-                        tarobj.name = tarobj.name.replace("/", "_").split('_', 1)[1]
-                        dropped_tar.extract(tarobj, task_dir)
-                        dropped_file_path = os.path.join(task_dir, tarobj.name)
-                        # Check the file hash for safelisting:
-                        with open(dropped_file_path, 'rb') as file_hash:
-                            data = file_hash.read()
-                            if not request.task.deep_scan:
-                                ssdeep_hash = ssdeep.hash(data)
-                                skip_file = False
-                                for seen_hash in added_hashes:
-                                    if ssdeep.compare(ssdeep_hash, seen_hash) >= self.ssdeep_match_pct:
-                                        skip_file = True
-                                        break
-                                # TODO: is this necessary to display if the data is duplicated? what do users get out of this
-                                if skip_file is True and dropped_sec is None:
-                                    dropped_sec = ResultSection(title_text='Dropped Files Information')
-                                    dropped_sec.add_tag("file.behavior",
-                                                        "Truncated extraction set")
-                                    parent_section.add_subsection(dropped_sec)
+                # The compression of the archive is the one requested in _generate_report, so none is probed for
+                with tarfile.open(dropped_tar_path, mode="r:bz2") as dropped_tar:
+                    for tarobj in dropped_tar:
+                        if tarobj.isfile() and not tarobj.isdir():  # a file, not a dir
+                            # A dropped file found
+                            dropped_name = os.path.split(tarobj.name)[1]
+                            # Fixup the name.. the tar originally has files/your/file/path
+                            tarobj.name = tarobj.name.replace("/", "_").split('_', 1)[1]
+                            # Files that are safelisted by name are skipped before anything is read from them
+                            if slist_check_dropped(dropped_name) or dropped_name.endswith('_info.txt'):
+                                continue
+                            # Each member is read from the archive exactly once, since going back over a member of a
+                            # compressed archive decompresses it again from the start. The file is hashed while it is
+                            # written to disk, and removed again if it turns out not to be resubmitted
+                            md5_hash = hashlib.md5()
+                            ssdeep_hash = None if request.task.deep_scan else ssdeep.Hash()
+                            dropped_file_path = self._extract_tar_member(
+                                dropped_tar, tarobj, task_dir, [h for h in (md5_hash, ssdeep_hash) if h is not None]
+                            )
+                            dropped_hash = md5_hash.hexdigest()
+                            if ssdeep_hash is not None:
+                                ssdeep_digest = ssdeep_hash.digest()
+                                if added_hashes.has_match(ssdeep_digest, self.ssdeep_match_pct):
+                                    # TODO: is this necessary to display if the data is duplicated? what do users get out of this
+                                    if dropped_sec is None:
+                                        dropped_sec = ResultSection(title_text='Dropped Files Information')
+                                        dropped_sec.add_tag("file.behavior",
+                                                            "Truncated extraction set")
+                                        parent_section.add_subsection(dropped_sec)
+                                    os.remove(dropped_file_path)
                                     continue
-                                else:
-                                    added_hashes.add(ssdeep_hash)
-                            dropped_hash = hashlib.md5(data).hexdigest()
-                            if dropped_hash == self.request.md5:
+                                added_hashes.add(ssdeep_digest)
+                            if dropped_hash == self.request.md5 or slist_check_hash(dropped_hash):
+                                os.remove(dropped_file_path)
                                 continue
-                        if not (slist_check_hash(dropped_hash) or slist_check_dropped(
-                                dropped_name) or dropped_name.endswith('_info.txt')):
                             message = "Dropped file during Cuckoo analysis."
                             # Resubmit
                             dropped_file_name = f"{cuckoo_task.id}_{dropped_name}"
                             try:
                                 self.request.add_extracted(dropped_file_path, dropped_file_name, message)
                             except MaxExtractedExceeded:
-                                self.log.warning(f"Cannot add extracted file {dropped_file_name} due to MaxExtractedExceeded")
+                                # Every following dropped file would be written to disk only to be refused as well
+                                self.log.warning(f"Cannot add extracted file {dropped_file_name} due to MaxExtractedExceeded, "
+                                                 f"skipping the remaining dropped files")
+                                break
                             self.log.debug(f"Submitted dropped file for analysis for task ID {cuckoo_task.id}: {dropped_file_name}")
             except Exception as e_x:
                 self.log.error(f"Error extracting dropped files: {e_x}")
@@ -770,7 +896,6 @@ class Cuckoo(ServiceBase):
                 with open(ps1_path, "a") as fh:
                     for item in json.loads(section.body):
                         fh.write(item["original"] + "\n")
-                fh.close()
                 self.log.debug(f"Adding extracted file {ps1_file_name}")
                 try:
                     self.request.add_extracted(ps1_path, ps1_file_name, "Deobfuscated PowerShell script from Cuckoo analysis")
@@ -789,14 +914,9 @@ class Cuckoo(ServiceBase):
         if not has_network:
             return
 
-        pcap_data = self.query_pcap(cuckoo_task)
-        if pcap_data:
-            pcap_file_name = "cuckoo_traffic.pcap"
-            pcap_path = os.path.join(self.working_directory, pcap_file_name)
-            pcap_file = open(pcap_path, 'wb')
-            pcap_file.write(pcap_data)
-            pcap_file.close()
-
+        pcap_file_name = "cuckoo_traffic.pcap"
+        pcap_path = self.query_pcap(cuckoo_task, output_path=os.path.join(self.working_directory, pcap_file_name))
+        if pcap_path:
             # Resubmit analysis pcap file
             try:
                 self.log.debug(f"Adding extracted file {pcap_file_name}")
@@ -806,14 +926,8 @@ class Cuckoo(ServiceBase):
                                "which has been exceeded in this submission")
 
     def report_machine_info(self, machine_name, cuckoo_task, parent_section):
-        machine_name_exists = False
-        machine = None
-        for machine in self.machines['machines']:
-            if machine['name'] == machine_name:
-                machine_name_exists = True
-                break
-
-        if not machine_name_exists:
+        machine = self.machines_by_name.get(machine_name)
+        if machine is None:
             self.log.warning(f"Machine {machine_name} does not exist in {self.machines}")
             return
 
@@ -846,15 +960,14 @@ class Cuckoo(ServiceBase):
                 machine_section.add_tag("dynamic.operating_system.processor", x64_IMAGE_SUFFIX)
 
         # The assumption here is that a machine's name will contain somewhere in it the pattern: <platform prefix><version><processor>
-        m = re.compile(MACHINE_NAME_REGEX).search(machine_name)
+        m = MACHINE_NAME_PATTERN.search(machine_name)
         if m and len(m.groups()) == 1:
             version = m.group(1)
             machine_section.add_tag("dynamic.operating_system.version", version)
 
     def _decode_mime_encoded_file_name(self):
         # Check the filename to see if it's mime encoded
-        mime_re = re.compile(r"^=\?.*\?=$")
-        if mime_re.match(self.file_name):
+        if MIME_ENCODED_FILE_NAME_PATTERN.match(self.file_name):
             self.log.debug("Found a mime encoded filename, will try and decode")
             try:
                 decoded_filename = email.header.decode_header(self.file_name)
@@ -862,7 +975,7 @@ class Cuckoo(ServiceBase):
                 self.log.debug(f"Using decoded filename {new_filename}")
                 self.file_name = new_filename
             except Exception as e:
-                new_filename = generate_random_words(1)
+                new_filename = secrets.token_hex(4)
                 self.log.warning(f"Problem decoding filename. Using randomly "
                                  f"generated filename {new_filename}. Error: {e}")
                 self.file_name = new_filename
@@ -1063,7 +1176,9 @@ class Cuckoo(ServiceBase):
             parent_section.add_subsection(dll_multi_section)
 
     # Isolating this sequence out because I can't figure out how to mock PE construction
-    def _create_PE_from_file_contents(self) -> PE:
+    def _create_PE_from_file_contents(self):
+        # pefile is slow to import and only needed for DLL submissions, so it is imported on first use
+        from pefile import PE, PEFormatError
         dll_parsed = None
         try:
             dll_parsed = PE(data=self.request.file_contents)
@@ -1075,47 +1190,71 @@ class Cuckoo(ServiceBase):
         # Retrieve artifacts from analysis
         self.log.debug(f"Generating cuckoo report tar.gz for {cuckoo_task.id}.")
 
-        # Submit cuckoo analysis report archive as a supplementary file
-        tar_report = self.query_report(cuckoo_task, fmt='all', params={'tar': 'gz'})
-        if tar_report is not None:
-            self._unpack_tar(tar_report, file_ext, cuckoo_task, parent_section)
+        tar_file_name = f"{cuckoo_task.id}_cuckoo_report.tar.gz"
+        tar_report_path = os.path.join(self.working_directory, tar_file_name)
+        dropped_tar_path = os.path.join(self.working_directory, f"{cuckoo_task.id}_dropped_files.tar")
+
+        # The archive of dropped files is downloaded in the background while the report archive is being unpacked.
+        # The background download never deletes the task, since that would pull it out from under the report being
+        # unpacked. Its errors are raised by dropped_future.result() on this thread instead, and _general_flow then
+        # deletes the task as it does for any other error. If this thread fails first, the download is aborted
+        # rather than waited on, since the task is about to be deleted, and whatever it wrote is removed
+        abort_dropped = Event()
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                dropped_future = executor.submit(self.query_report, cuckoo_task, 'dropped', params={'tar': 'bz2'},
+                                                 output_path=dropped_tar_path, delete_task_on_error=False,
+                                                 abort_event=abort_dropped)
+                try:
+                    # Submit cuckoo analysis report archive as a supplementary file
+                    tar_report_path = self.query_report(cuckoo_task, fmt='all', params={'tar': 'gz'},
+                                                        output_path=tar_report_path)
+                    if tar_report_path is not None:
+                        self._unpack_tar(tar_report_path, file_ext, cuckoo_task, parent_section)
+                except Exception:
+                    abort_dropped.set()
+                    raise
+
+                dropped_tar_path = dropped_future.result()
+        except Exception:
+            if os.path.exists(dropped_tar_path):
+                os.remove(dropped_tar_path)
+            raise
 
         # Submit dropped files and pcap if available:
         # TODO: passing request and cuckoo_task.id is unnecessary since they are class attributes
-        self.check_dropped(self.request, cuckoo_task, parent_section)
+        self.check_dropped(self.request, cuckoo_task, parent_section, dropped_tar_path)
         self.check_powershell(cuckoo_task.id, parent_section)
         # self.check_pcap(cuckoo_task.id)
 
-    def _unpack_tar(self, tar_report, file_ext, cuckoo_task, parent_section):
-        tar_file_name = f"{cuckoo_task.id}_cuckoo_report.tar.gz"
-        tar_report_path = os.path.join(self.working_directory, tar_file_name)
+    def _unpack_tar(self, tar_report_path, file_ext, cuckoo_task, parent_section):
+        tar_file_name = os.path.basename(tar_report_path)
 
-        self._add_tar_ball_as_supplementary_file(tar_file_name, tar_report_path, tar_report, cuckoo_task)
-        tar_obj = tarfile.open(tar_report_path)
+        self._add_tar_ball_as_supplementary_file(tar_file_name, tar_report_path, cuckoo_task)
+        with tarfile.open(tar_report_path, mode="r:gz") as tar_obj:
+            # The member index of the archive is only walked once, and then shared by the helpers below. The members
+            # are passed around as TarInfo objects so that extracting one never has to look it up by name again
+            tar_obj_members = tar_obj.getmembers()
 
-        report_json_path = self._add_json_as_supplementary_file(tar_obj, cuckoo_task)
-        if report_json_path:
-            self._build_report(report_json_path, file_ext, cuckoo_task, parent_section)
+            report_json_path = self._add_json_as_supplementary_file(tar_obj, tar_obj_members, cuckoo_task)
+            if report_json_path:
+                self._build_report(report_json_path, file_ext, cuckoo_task, parent_section)
 
-        # Check for any extra files in full report to add as extracted files
-        # special 'supplementary' directory
-        # memory artifacts
-        try:
-            # TODO: This doesn't need to happen with the tar obj open
-            self._extract_console_output(cuckoo_task.id)
-            self._extract_hollowshunter(tar_obj, cuckoo_task.id, parent_section)
-            self._extract_artifacts(tar_obj, cuckoo_task.id)
+            # Check for any extra files in full report to add as extracted files
+            # special 'supplementary' directory
+            # memory artifacts
+            try:
+                # TODO: This doesn't need to happen with the tar obj open
+                self._extract_console_output(cuckoo_task.id)
+                self._extract_hollowshunter(tar_obj, tar_obj_members, cuckoo_task.id, parent_section)
+                self._extract_artifacts(tar_obj, tar_obj_members, cuckoo_task.id)
 
-        except Exception as e:
-            self.log.exception(f"Unable to add extra file(s) for "
-                               f"task {cuckoo_task.id}. Exception: {e}")
-        tar_obj.close()
+            except Exception as e:
+                self.log.exception(f"Unable to add extra file(s) for "
+                                   f"task {cuckoo_task.id}. Exception: {e}")
 
-    def _add_tar_ball_as_supplementary_file(self, tar_file_name, tar_report_path, tar_report, cuckoo_task):
+    def _add_tar_ball_as_supplementary_file(self, tar_file_name, tar_report_path, cuckoo_task):
         try:
-            report_file = open(tar_report_path, 'wb')
-            report_file.write(tar_report)
-            report_file.close()
             self.log.debug(f"Adding supplementary file {tar_file_name} for {cuckoo_task.id}")
             self.request.add_supplementary(tar_report_path, tar_file_name,
                                            "Cuckoo Sandbox analysis report archive (tar.gz)")
@@ -1123,18 +1262,18 @@ class Cuckoo(ServiceBase):
             self.log.exception(f"Unable to add tar of complete report for "
                                f"task {cuckoo_task.id} due to {e}")
 
-    def _add_json_as_supplementary_file(self, tar_obj, cuckoo_task) -> str:
+    def _add_json_as_supplementary_file(self, tar_obj, tar_obj_members, cuckoo_task) -> str:
         # Attach report.json as a supplementary file. This is duplicating functionality
         # a little bit, since this information is included in the JSON result section
         report_json_path = ""
         try:
             member_name = "reports/report.json"
-            if member_name in tar_obj.getnames():
+            member = next((m for m in tar_obj_members if m.name == member_name), None)
+            if member is not None:
                 task_dir = os.path.join(self.working_directory, f"{cuckoo_task.id}")
-                report_json_path = os.path.join(task_dir, member_name)
                 report_name = f"{cuckoo_task.id}_report.json"
 
-                tar_obj.extract(member_name, path=task_dir)
+                report_json_path = self._extract_tar_member(tar_obj, member, task_dir)
                 self.log.debug(f"Adding supplementary file {report_name} for task ID {cuckoo_task.id}")
                 self.request.add_supplementary(
                     report_json_path,
@@ -1147,10 +1286,14 @@ class Cuckoo(ServiceBase):
 
     def _build_report(self, report_json_path, file_ext, cuckoo_task, parent_section):
         try:
-            # Setting environment recursion limit for large JSONs
-            sys.setrecursionlimit(int(self.config['recursion_limit']))
-            # Reading, decoding and converting to JSON
-            cuckoo_task.report = json.loads(open(report_json_path, "rb").read().decode('utf-8'))
+            # Reading and converting to JSON. orjson parses the raw bytes, so the report is never decoded to a str
+            with open(report_json_path, "rb") as report_json_file:
+                report_data = report_json_file.read()
+            try:
+                cuckoo_task.report = orjson.loads(report_data)
+            except orjson.JSONDecodeError:
+                # orjson rejects NaN/Infinity and lone surrogate escapes, which the json module accepts
+                cuckoo_task.report = json.loads(report_data.decode("utf-8"))
         except JSONDecodeError as e:
             self.log.exception(f"Failed to decode the json: {str(e)}")
             raise e
@@ -1178,19 +1321,16 @@ class Cuckoo(ServiceBase):
                                              self.config.get("random_ip_range"))
         except RecoverableError as e:
             self.log.error(f"Recoverable error. Error message: {repr(e)}")
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise
         except CuckooProcessingException:
             # Catching the CuckooProcessingException, attempting to delete the file, and then carrying on
             self.log.error("Processing error occurred generating report")
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise
         except Exception as e:
             self.log.error(f"Error generating report: {repr(e)}")
-            if cuckoo_task and cuckoo_task.id is not None:
-                self.delete_task(cuckoo_task)
+            self._safely_delete_task(cuckoo_task)
             raise CuckooProcessingException(f"Unable to generate report for task due to: {repr(e)}")
 
     def _extract_console_output(self, task_id):
@@ -1200,7 +1340,7 @@ class Cuckoo(ServiceBase):
         if os.path.exists(console_output_file_path):
             self.request.add_supplementary(console_output_file_path, console_output_file_name, "Console Output Observed")
 
-    def _extract_artifacts(self, tar_obj, task_id):
+    def _extract_artifacts(self, tar_obj, tar_obj_members, task_id):
         # Extract buffers, screenshots and anything else
         tarball_file_map = {
             "buffer": "Extracted buffer",
@@ -1215,47 +1355,58 @@ class Cuckoo(ServiceBase):
 
         # Get the max size for extract files, used a few times after this
         max_extracted_size = self.config['max_file_size']
-        tar_obj_members = [x.name for x in tar_obj.getmembers() if
-                           x.isfile() and x.size < max_extracted_size]
+
+        # Sort the members into one bucket per prefix in a single pass, rather than scanning them all for each prefix
+        buckets = {key: [] for key in tarball_file_map}
+        for member in tar_obj_members:
+            if not member.isfile() or member.size >= max_extracted_size:
+                continue
+            for key, bucket in buckets.items():
+                if member.name.startswith(key):
+                    bucket.append(member)
+                    break
+
         task_dir = os.path.join(self.working_directory, f"{task_id}")
+        extracted = []
+        supplementary = []
         for key, value in tarball_file_map.items():
-            key_hits = [x for x in tar_obj_members if x.startswith(key)]
-            for f in key_hits:
-                destination_file_path = os.path.join(task_dir, f)
-                tar_obj.extract(f, path=task_dir)
+            for member in buckets[key]:
+                f = member.name
+                destination_file_path = self._extract_tar_member(tar_obj, member, task_dir)
                 file_name = f"{task_id}_{f}"
                 if key == "sysmon":
                     destination_file_path, f = self._encode_sysmon_file(destination_file_path, f)
                     self.log.debug(f"Adding Sysmon log file for task ID {task_id}: {file_name}")
-                    try:
-                        self.request.add_extracted(destination_file_path, file_name, value)
-                    except MaxExtractedExceeded:
-                        self.log.warning(
-                            f"Cannot add extracted file {destination_file_path} due to MaxExtractedExceeded")
+                    extracted.append((destination_file_path, file_name, value))
                 elif key == "supplementary":
                     self.log.debug(f"Adding supplementary file for task ID {task_id}: {file_name}")
-                    self.request.add_supplementary(destination_file_path, file_name, value)
+                    supplementary.append((destination_file_path, file_name, value))
                 else:
                     self.log.debug(f"Adding extracted file for task ID {task_id}: {file_name}")
-                    try:
-                        self.request.add_extracted(destination_file_path, file_name, value)
-                    except MaxExtractedExceeded:
-                        self.log.warning(
-                            f"Cannot add extracted file {destination_file_path} due to MaxExtractedExceeded")
+                    extracted.append((destination_file_path, file_name, value))
+
+        for destination_file_path, file_name, value in supplementary:
+            self.request.add_supplementary(destination_file_path, file_name, value)
 
-    def _extract_hollowshunter(self, tar_obj, task_id, parent_section):
+        # Once the extracted file limit is reached, every following add_extracted would raise as well
+        try:
+            for destination_file_path, file_name, value in extracted:
+                self.request.add_extracted(destination_file_path, file_name, value)
+        except MaxExtractedExceeded:
+            self.log.warning(f"Cannot add extracted file {destination_file_path} or any of the files after it "
+                             f"due to MaxExtractedExceeded")
+
+    def _extract_hollowshunter(self, tar_obj, tar_obj_members, task_id, parent_section):
         # HollowsHunter section
         hollowshunter_sec = ResultSection(title_text='HollowsHunter')
         task_dir = os.path.join(self.working_directory, f"{task_id}")
         # Only if there is a 1 or more exe, shc dumps
-        if any(re.match(HOLLOWSHUNTER_DUMP_REGEX, f) for f in tar_obj.getnames()):
+        if any(HOLLOWSHUNTER_DUMP_PATTERN.match(m.name) for m in tar_obj_members):
             # Add HollowsHunter report files as supplementary
-            report_pattern = re.compile(HOLLOWSHUNTER_REPORT_REGEX)
-            report_list = list(filter(report_pattern.match, tar_obj.getnames()))
-            for report_path in report_list:
-                report_json_path = os.path.join(task_dir, report_path)
-                report_name = f"{task_id}_{report_path}"
-                tar_obj.extract(report_path, path=task_dir)
+            report_list = [m for m in tar_obj_members if HOLLOWSHUNTER_REPORT_PATTERN.match(m.name)]
+            for report_member in report_list:
+                report_name = f"{task_id}_{report_member.name}"
+                report_json_path = self._extract_tar_member(tar_obj, report_member, task_dir)
                 self.log.debug(f"Adding HollowsHunter report {report_name} as supplementary file for task ID {task_id}")
                 self.request.add_supplementary(
                     report_json_path,
@@ -1264,19 +1415,19 @@ class Cuckoo(ServiceBase):
                 )
 
             hh_tuples = [(
-                None, HOLLOWSHUNTER_EXE_REGEX,
+                None, HOLLOWSHUNTER_EXE_PATTERN,
                 'HollowsHunter Injected Portable Executable', 17
             ), (
-                None, HOLLOWSHUNTER_SHC_REGEX,
+                None, HOLLOWSHUNTER_SHC_PATTERN,
                 "HollowsHunter Shellcode", None
             ), (
-                None, HOLLOWSHUNTER_DLL_REGEX,
+                None, HOLLOWSHUNTER_DLL_PATTERN,
                 "HollowsHunter DLL", None
             )]
+            max_extracted_reached = False
             for hh_tuple in hh_tuples:
-                section, regex, section_title, section_heur = hh_tuple
-                pattern = re.compile(regex)
-                dump_list = list(filter(pattern.match, tar_obj.getnames()))
+                section, pattern, section_title, section_heur = hh_tuple
+                dump_list = [m for m in tar_obj_members if pattern.match(m.name)]
                 if dump_list:
                     section = ResultSection(title_text=section_title)
                     if section_heur:
@@ -1284,16 +1435,19 @@ class Cuckoo(ServiceBase):
                         heur.add_signature_id("hollowshunter_pe")
                         section.heuristic = heur
 
-                for dump_path in dump_list:
-                    section.add_tag("dynamic.process.file_name", dump_path)
-                    dump_file_path = os.path.join(task_dir, dump_path)
-                    tar_obj.extract(dump_path, path=task_dir)
+                for dump_member in dump_list:
+                    section.add_tag("dynamic.process.file_name", dump_member.name)
+                    # Once the extracted file limit is reached, the remaining dumps are only tagged
+                    if max_extracted_reached:
+                        continue
+                    dump_file_path = self._extract_tar_member(tar_obj, dump_member, task_dir)
                     # Resubmit
                     try:
-                        dump_file_name = f"{task_id}_{dump_path}"
+                        dump_file_name = f"{task_id}_{dump_member.name}"
                         self.request.add_extracted(dump_file_path, dump_file_name, section_title)
                         self.log.debug(f"Submitted HollowsHunter dump for analysis: {dump_file_name}")
                     except MaxExtractedExceeded:
+                        max_extracted_reached = True
                         self.log.warning(
                             f"Cannot add extracted file {dump_file_name} due to MaxExtractedExceeded")
                 if section and len(section.tags) > 0:
@@ -1301,6 +1455,20 @@ class Cuckoo(ServiceBase):
         if len(hollowshunter_sec.subsections) > 0:
             parent_section.add_subsection(hollowshunter_sec)
 
+    @staticmethod
+    def _extract_tar_member(tar_obj, member, task_dir, hash_objs=()) -> str:
+        # Copy the contents of the member ourselves, since tar_obj.extract also restores the ownership, permissions and
+        # timestamps of each file, none of which matter for files that are only read back by Assemblyline.
+        # Any hash objects given are fed the contents on the way, so that the member does not have to be read twice
+        destination_file_path = os.path.join(task_dir, member.name)
+        os.makedirs(os.path.dirname(destination_file_path), exist_ok=True)
+        with tar_obj.extractfile(member) as src, open(destination_file_path, "wb") as dst:
+            for chunk in iter(lambda: src.read(REPORT_STREAM_CHUNK_SIZE), b""):
+                for hash_obj in hash_objs:
+                    hash_obj.update(chunk)
+                dst.write(chunk)
+        return destination_file_path
+
     @staticmethod
     def _encode_sysmon_file(destination_file_path, f):
         return encode_file(destination_file_path, f, metadata={'al': {'type': 'metadata/sysmon'}})
@@ -1381,10 +1549,3 @@ class Cuckoo(ServiceBase):
                                     f"Cuckoo deployment include {available_images}."
                 self.file_res.add_section(no_image_sec)
         return image_requested, relevant_images
-
-
-def generate_random_words(num_words):
-    alpha_nums = [chr(x + 65) for x in range(26)] + [chr(x + 97) for x in range(26)] + [str(x) for x in range(10)]
-    return " ".join(["".join([random.choice(alpha_nums)
-                              for _ in range(int(random.random() * 10) + 2)])
-                     for _ in range(num_words)])
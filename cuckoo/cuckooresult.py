@@ -19,7 +19,22 @@ IP_REGEX = re.compile(IP_REGEX)
 # Remove the part of the regex that looks to match the entire line
 URL_REGEX = re.compile(FULL_URI.lstrip("^").rstrip("$"))
 MD5_REGEX = re.compile(MD5_REGEX)
+# Matches the file extension at the end of a URI path
+FILE_EXTENSION_REGEX = re.compile(r'[^\\]*\.(\w+)$')
 UNIQUE_IP_LIMIT = 100
+# Paths that are noise, or to be ignored
+SKIPPED_PATHS = frozenset(["/"])
+
+# Signature processing constants, as sets since they are checked for every signature and mark
+SKIPPED_SIGS = frozenset(CUCKOO_DROPPED_SIGNATURES)
+SKIPPED_SIG_IOCS = frozenset()
+SKIPPED_MARK_ITEMS = frozenset(["type", "suspicious_features", "entropy", "process", "useragent"])
+SKIPPED_CATEGORY_IOCS = frozenset(["section"])
+SKIPPED_FAMILIES = frozenset(["generic"])
+# Signatures that need to be double checked in case they return false positives
+FALSE_POSITIVE_SIGS = frozenset(["creates_doc", "creates_hidden_file", "creates_exe", "creates_shortcut"])
+SILENT_IOCS = frozenset(["creates_shortcut", "ransomware_mass_file_delete", "suspicious_process",
+                         "uses_windows_utilities", "creates_exe", "deletes_executed_files"])
 
 
 # noinspection PyBroadException
@@ -112,29 +127,35 @@ def generate_al_result(api_report, al_result, file_ext, random_ip_range):
 
 def process_debug(debug, al_result):
     error_res = ResultSection(title_text='Analysis Errors')
+    # The lines are collected and set on the section at once, since every add_line rebuilds the whole body
+    error_lines = []
     for error in debug['errors']:
         err_str = str(error)
         # TODO: what is the point of lower-casing it?
         err_str = err_str.lower()
         if err_str is not None and len(err_str) > 0:
-            error_res.add_line(error)
+            error_lines.append(safe_str(error))
 
     # Including error that is not reported conveniently by Cuckoo for whatever reason
     for analyzer_log in debug['log']:
         if "ERROR:" in analyzer_log:  # Hoping that Cuckoo logs as ERROR
             split_log = analyzer_log.split("ERROR:")
-            error_res.add_line(split_log[1].lstrip().rstrip("\n"))
+            error_lines.append(safe_str(split_log[1].lstrip().rstrip("\n")))
 
     # Including error that is not reported conveniently by Cuckoo for whatever reason
     previous_log = None
     for log in debug['cuckoo']:
         if log == "\n":  # There is always a newline character following a stacktrace
-            error_res.add_line(previous_log.rstrip("\n"))
+            error_lines.append(safe_str(previous_log.rstrip("\n")))
         elif "ERROR:" in log:  # Hoping that Cuckoo logs as ERROR
             split_log = log.split("ERROR:")
-            error_res.add_line(split_log[1].lstrip().rstrip("\n"))
+            error_lines.append(safe_str(split_log[1].lstrip().rstrip("\n")))
         previous_log = log
 
+    # Empty lines are dropped, so that an ERROR: marker with nothing after it does not add an empty section
+    error_lines = [line for line in error_lines if line]
+    if error_lines:
+        error_res.add_lines(error_lines)
     if error_res.body and len(error_res.body) > 0:
         al_result.add_subsection(error_res)
 
@@ -171,14 +192,9 @@ def process_behaviour(behaviour: dict, al_result: ResultSection, process_map: di
         al_result.add_subsection(process_tree_section)
 
     # Gathering apistats to determine if calls have been limited
-    apistats = behaviour.get("apistats", [])
+    apistats = behaviour.get("apistats", {})
     # Get the total number of api calls per pid
-    api_sums = {}
-    for pid in apistats:
-        api_sums[pid] = 0
-        process_apistats = apistats[pid]
-        for api_call in process_apistats:
-            api_sums[pid] += process_apistats[api_call]
+    api_sums = {pid: sum(process_apistats.values()) for pid, process_apistats in apistats.items()}
 
     # Get information about processes to return as events
     processes = behaviour["processes"]
@@ -385,19 +401,10 @@ def process_signatures(sigs: list, al_result: ResultSection, random_ip_range: st
     if len(sigs) <= 0:
         return False
 
-    # TODO: these should be constants
     # Flag used to indicate if process_martian signature should be used in process_behaviour
     is_process_martian = False
     sigs_res = ResultSection(title_text="Signatures")
-    skipped_sigs = CUCKOO_DROPPED_SIGNATURES
-    skipped_sig_iocs = []
-    skipped_mark_items = ["type", "suspicious_features", "entropy", "process", "useragent"]
-    skipped_category_iocs = ["section"]
-    skipped_families = ["generic"]
-    false_positive_sigs = ["creates_doc", "creates_hidden_file", "creates_exe", "creates_shortcut"]  # Signatures that need to be double checked in case they return false positives
     inetsim_network = ip_network(random_ip_range)
-    skipped_paths = ["/"]
-    silent_iocs = ["creates_shortcut", "ransomware_mass_file_delete", "suspicious_process", "uses_windows_utilities", "creates_exe", "deletes_executed_files"]
     # Sometimes the filename gets shortened
     target_filename_remainder = target_filename
     if len(target_filename) > 12:
@@ -407,7 +414,7 @@ def process_signatures(sigs: list, al_result: ResultSection, random_ip_range: st
         sig_injected_itself = False  # this also indicates a false positive
         sig_name = sig['name']
 
-        if sig_name in skipped_sigs:
+        if sig_name in SKIPPED_SIGS:
             if sig_name == "process_martian":
                 is_process_martian = True
             continue
@@ -415,7 +422,7 @@ def process_signatures(sigs: list, al_result: ResultSection, random_ip_range: st
         # Check if signature is a false positive
         # Flag that represents if false positive exists
         fp = False
-        if sig_name in false_positive_sigs:
+        if sig_name in FALSE_POSITIVE_SIGS:
             marks = sig["marks"]
             # If all marks are false positives, then flag as false positive sig
             fp_count = 0
@@ -475,7 +482,7 @@ def process_signatures(sigs: list, al_result: ResultSection, random_ip_range: st
         sig_res.heuristic = sig_heur
 
         # Getting the signature family and tagging it
-        sig_families = [family for family in sig.get('families', []) if family not in skipped_families]
+        sig_families = [family for family in sig.get('families', []) if family not in SKIPPED_FAMILIES]
         if len(sig_families) > 0:
             sig_res.add_line('\tFamilies: ' + ','.join([safe_str(x) for x in sig_families]))
             for family in sig_families:
@@ -494,7 +501,7 @@ def process_signatures(sigs: list, al_result: ResultSection, random_ip_range: st
         # Find any indicators of compromise from the signature marks
         markcount = sig.get("markcount", 0)
         fp_count = 0
-        if markcount > 0 and sig_name not in skipped_sig_iocs:
+        if markcount > 0 and sig_name not in SKIPPED_SIG_IOCS:
             sig_marks = sig.get('marks', [])
             process_names = []
             injected_processes = []
@@ -505,13 +512,12 @@ def process_signatures(sigs: list, al_result: ResultSection, random_ip_range: st
                 if process_map.get(pid):
                     process_map[pid]["signatures"].add(json.dumps({sig_name: translated_score}))
                 # Mapping the process name to the process id
-                process_map.get(pid, {})
                 process_name = process_map.get(pid, {}).get("name")
                 if mark_type == "generic" and sig_name not in ["network_cnc_http", "nolookup_communication", "suspicious_powershell", "exploit_heapspray"]:
                     for item in mark:
                         # Check if key is not flagged to skip, and that we
                         # haven't already raised this ioc
-                        if item not in skipped_mark_items:
+                        if item not in SKIPPED_MARK_ITEMS:
                             # Now check if any item in signature is safelisted explicitly or in inetsim network
                             if not contains_safelisted_value(mark[item]):
                                 if not is_ip(mark[item]) or \
@@ -547,18 +553,18 @@ def process_signatures(sigs: list, al_result: ResultSection, random_ip_range: st
                 elif mark_type == "ioc":
                     ioc = mark["ioc"]
                     category = mark.get("category")
-                    if category and category not in skipped_category_iocs:
+                    if category and category not in SKIPPED_CATEGORY_IOCS:
                         # Now check if any item in signature is safelisted explicitly or in inetsim network
                         if not contains_safelisted_value(ioc):
                             if sig_name in ["network_http", "network_http_post"]:
                                 http_string = ioc.split()
                                 url_pieces = urlparse(http_string[1])
-                                if url_pieces.path not in skipped_paths:
+                                if url_pieces.path not in SKIPPED_PATHS:
                                     sig_res.add_tag("network.dynamic.uri", safe_str(http_string[1]))
                                 sig_res.add_line('\tIOC: %s' % ioc)
                             elif sig_name == "persistence_autorun":
                                 sig_res.add_tag("dynamic.autorun_location", ioc)
-                            elif sig_name in silent_iocs:
+                            elif sig_name in SILENT_IOCS:
                                 # Nothing to see here, just avoiding printing out the IOC line in the result body
                                 pass
                             elif not is_ip(ioc) or \
@@ -630,10 +636,10 @@ def process_signatures(sigs: list, al_result: ResultSection, random_ip_range: st
 def contains_safelisted_value(val: str) -> bool:
     if not val or not isinstance(val, str):
         return False
-    ip = re.search(IP_REGEX, val)
-    url = re.search(URL_REGEX, val)
-    domain = re.search(DOMAIN_REGEX, val)
-    md5_hash = re.search(MD5_REGEX, val)
+    ip = IP_REGEX.search(val)
+    url = URL_REGEX.search(val)
+    domain = DOMAIN_REGEX.search(val)
+    md5_hash = MD5_REGEX.search(val)
     if ip is not None:
         ip = ip.group()
         if slist_check_ip(ip):
@@ -660,9 +666,6 @@ def process_network(network: dict, al_result: ResultSection, random_ip_range: st
     events = []  # This will contain all network events
     network_res = ResultSection(title_text="Network Activity")
 
-    # List containing paths that are noise, or to be ignored
-    skipped_paths = ["/"]
-
     inetsim_network = ip_network(random_ip_range)
 
     # DNS Section
@@ -698,7 +701,7 @@ def process_network(network: dict, al_result: ResultSection, random_ip_range: st
     # This result section will contain all of the "flows" from src ip to dest ip
     netflows_sec = ResultSection(title_text="Network Flows")
 
-    dns_servers = network.get("dns_servers", [])
+    dns_servers = set(network.get("dns_servers", []))
     netflow_protocols = ["udp", "tcp"]
     for protocol in netflow_protocols:
         network_calls = [x for x in network.get(protocol, [])]
@@ -706,6 +709,7 @@ def process_network(network: dict, al_result: ResultSection, random_ip_range: st
             continue
         elif len(network_calls) > 50:
             network_calls_made_to_unique_ips = []
+            unique_dst_port_pairs = set()
             # Collapsing network calls into calls made to unique IP+port combos
             for network_call in network_calls:
                 if len(network_calls_made_to_unique_ips) >= 100:
@@ -716,8 +720,9 @@ def process_network(network: dict, al_result: ResultSection, random_ip_range: st
                                                    f"in cuckoo_traffic.pcap"
                     netflows_sec.add_subsection(too_many_unique_ips_sec)
                     break
-                dst_port_pair = json.dumps({network_call["dst"]: network_call["dport"]})
-                if dst_port_pair not in [json.dumps({x["dst"]: x["dport"]}) for x in network_calls_made_to_unique_ips]:
+                dst_port_pair = (network_call["dst"], network_call["dport"])
+                if dst_port_pair not in unique_dst_port_pairs:
+                    unique_dst_port_pairs.add(dst_port_pair)
                     network_calls_made_to_unique_ips.append(network_call)
             network_calls = network_calls_made_to_unique_ips
         for network_call in network_calls:
@@ -738,7 +743,7 @@ def process_network(network: dict, al_result: ResultSection, random_ip_range: st
                 "dest_port": network_call["dport"],
                 "process_name": None
             }
-            if dst in resolved_ips.keys():
+            if dst in resolved_ips:
                 network_flow["dom"] = resolved_ips[dst]["domain"]
                 process_name = resolved_ips[dst].get("process_name")
                 if process_name:
@@ -820,10 +825,13 @@ def process_network(network: dict, al_result: ResultSection, random_ip_range: st
     if protocol_res_sec and len(protocol_res_sec.tags) > 0:
         network_res.add_subsection(protocol_res_sec)
     if len(network_flows_table) > 0:
-        # Need to convert each dictionary to a string in order to get the set of network_flows_table, since dictionaries are not hashable
+        # Dictionaries are not hashable, so the items of each network flow are used to find the duplicates
         unique_netflows = []
+        seen_netflows = set()
         for item in network_flows_table:
-            if item not in unique_netflows:  # Remove duplicates
+            netflow_key = frozenset(item.items())
+            if netflow_key not in seen_netflows:  # Remove duplicates
+                seen_netflows.add(netflow_key)
                 unique_netflows.append(item)
         netflows_sec.body = json.dumps(unique_netflows)
         netflows_sec.body_format = BODY_FORMAT.TABLE
@@ -831,6 +839,7 @@ def process_network(network: dict, al_result: ResultSection, random_ip_range: st
 
     # HTTP/HTTPS section
     req_table = []
+    seen_reqs = set()
     http_protocols = ["http", "https", "http_ex", "https_ex"]
     for protocol in http_protocols:
         http_calls = [x for x in network.get(protocol, [])]
@@ -869,7 +878,9 @@ def process_network(network: dict, al_result: ResultSection, random_ip_range: st
                     send = network_call.get("send", {}) or network_call.get("InternetConnectW", {}) or network_call.get("InternetConnectA", {})
                     if send != {} and (send.get("service", 0) == 3 or send.get("buffer", "") == request):
                         req["process_name"] = process_details["name"] + " (" + str(process) + ")"
-            if req not in req_table:
+            req_key = frozenset(req.items())
+            if req_key not in seen_reqs:
+                seen_reqs.add(req_key)
                 req_table.append(req)
 
     if len(req_table) > 0:
@@ -885,16 +896,17 @@ def process_network(network: dict, al_result: ResultSection, random_ip_range: st
             if is_ip(host):
                 http_sec.add_tag("network.dynamic.ip", host)
             else:
-                if path not in skipped_paths:
+                if path not in SKIPPED_PATHS:
                     http_sec.add_tag("network.dynamic.domain", host)
                     http_sec.add_tag("network.dynamic.uri", http_call["uri"])
             http_sec.add_tag("network.port", http_call["port"])
-            if path not in skipped_paths:
+            if path not in SKIPPED_PATHS:
                 http_sec.add_tag("network.dynamic.uri_path", path)
                 # Now we're going to try to detect if a remote file is attempted to be downloaded over HTTP
                 if http_call["method"] == "GET":
                     split_path = path.rsplit("/", 1)
-                    if len(split_path) > 1 and re.search(r'[^\\]*\.(\w+)$', split_path[-1]):
+                    # A file name needs a dot, so the regex only runs on the path segments that can match
+                    if len(split_path) > 1 and "." in split_path[-1] and FILE_EXTENSION_REGEX.search(split_path[-1]):
                         remote_file_access_sec.add_tag("network.dynamic.uri", http_call["uri"])
                         if not remote_file_access_sec.heuristic:
                             remote_file_access_sec.set_heuristic(1003)
@@ -1093,15 +1105,16 @@ def process_decrypted_buffers(process_map: dict, al_result: ResultSection):
                 buffer = call["OutputDebugStringA"]["string"]
             if not buffer:
                 continue
-            ips = set(re.findall(IP_REGEX, buffer))
+            ips = set(IP_REGEX.findall(buffer))
             # There is overlap here between regular expressions, so we want to isolate domains that are not ips
-            domains = set(re.findall(DOMAIN_REGEX, buffer)) - ips
-            uris = set(re.findall(URL_REGEX, buffer))
+            domains = set(DOMAIN_REGEX.findall(buffer)) - ips
+            uris = set(URL_REGEX.findall(buffer))
             unique_ips = unique_ips.union(ips)
             unique_domains = unique_domains.union(domains)
             unique_uris = unique_uris.union(uris)
-            if {"Decrypted Buffer": safe_str(buffer)} not in buffer_body:
-                buffer_body.append({"Decrypted Buffer": safe_str(buffer)})
+            buffer_row = {"Decrypted Buffer": safe_str(buffer)}
+            if buffer_row not in buffer_body:
+                buffer_body.append(buffer_row)
     for ip in unique_ips:
         safe_ip = safe_str(ip)
         buffer_res.add_tag("network.static.ip", safe_ip)
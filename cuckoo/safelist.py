@@ -408,6 +408,12 @@ SAFELIST_URIS = {
     'Google': r'https?://www\.google\.com',
 }
 
+# Dropped files are checked against every one of these, so the lists are also kept as sets and the common patterns as a
+# single compiled alternation, rather than walking each entry on every check
+SAFELIST_DROPPED_SET = frozenset(SAFELIST_DROPPED)
+SAFELIST_HASHES_SET = frozenset(SAFELIST_HASHES)
+SAFELIST_COMMON_REGEX = re.compile("|".join(f"(?:{pattern})" for pattern in SAFELIST_COMMON_PATTERNS.values()))
+
 
 def match(data, sigs):
     for name, sig in sigs.items():
@@ -437,14 +443,14 @@ def slist_check_uri(uri):
 
 
 def slist_check_dropped(name):
-    if name in SAFELIST_DROPPED:
+    if name in SAFELIST_DROPPED_SET:
         return True
-    elif match(name, SAFELIST_COMMON_PATTERNS):
+    elif SAFELIST_COMMON_REGEX.match(name):
         return True
     return False
 
 
 def slist_check_hash(filehash):
-    if filehash in SAFELIST_HASHES:
+    if filehash in SAFELIST_HASHES_SET:
         return True
     return False
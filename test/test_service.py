@@ -1,3 +1,4 @@
+import io
 import os
 import json
 import pytest
@@ -126,11 +127,20 @@ def dummy_tar_class():
         def extract(self, output, path=None):
             pass
 
+        def extractfile(self, member):
+            return io.BytesIO(b"blah")
+
         def getmembers(self):
             return self.members
 
         def close(self):
             pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.close()
     yield DummyTar
 
 
@@ -261,11 +271,30 @@ class TestModule:
         assert GUEST_VM_START_TIMEOUT == 360
         assert REPORT_GENERATION_TIMEOUT == 300
 
+    @staticmethod
+    def test_poll_backoff_constants(cuckoo_class_instance):
+        from cuckoo.cuckoo import CUCKOO_POLL_BACKOFF_MULTIPLIER, CUCKOO_POLL_BACKOFF_MAX, CUCKOO_POLL_JITTER
+        assert CUCKOO_POLL_BACKOFF_MULTIPLIER == 500
+        assert CUCKOO_POLL_BACKOFF_MAX == 30
+        assert CUCKOO_POLL_JITTER == 0.5
+
+    @staticmethod
+    def test_retry_backoff_constants(cuckoo_class_instance):
+        from cuckoo.cuckoo import CUCKOO_RETRY_BACKOFF_MULTIPLIER, CUCKOO_RETRY_BACKOFF_MAX, CUCKOO_RETRY_JITTER
+        assert CUCKOO_RETRY_BACKOFF_MULTIPLIER == 250
+        assert CUCKOO_RETRY_BACKOFF_MAX == 5
+        assert CUCKOO_RETRY_JITTER == 0.5
+
     @staticmethod
     def test_analysis_constants(cuckoo_class_instance):
         from cuckoo.cuckoo import ANALYSIS_TIMEOUT
         assert ANALYSIS_TIMEOUT == 150
 
+    @staticmethod
+    def test_machines_cache_constants(cuckoo_class_instance):
+        from cuckoo.cuckoo import MACHINES_CACHE_TTL
+        assert MACHINES_CACHE_TTL == 60
+
     @staticmethod
     def test_image_tag_constants(cuckoo_class_instance):
         from cuckoo.cuckoo import LINUX_IMAGE_PREFIX, WINDOWS_IMAGE_PREFIX, x86_IMAGE_SUFFIX, x64_IMAGE_SUFFIX, \
@@ -287,7 +316,7 @@ class TestModule:
     @staticmethod
     def test_supported_extensions_constant(cuckoo_class_instance):
         from cuckoo.cuckoo import SUPPORTED_EXTENSIONS
-        assert SUPPORTED_EXTENSIONS == ["cpl", "dll", "exe", "pdf", "doc", "docm", "docx", "dotm", "rtf", "mht", "xls", "xlsm", "xlsx", "ppt", "pptx", "pps", "ppsx", "pptm", "potm", "potx", "ppsm", "htm", "html", "jar", "rar", "swf", "py", "pyc", "vbs", "msi", "ps1", "msg", "eml", "js", "wsf", "elf", "bin", "hta", "lnk", "hwp", "pub"]
+        assert SUPPORTED_EXTENSIONS == {"cpl", "dll", "exe", "pdf", "doc", "docm", "docx", "dotm", "rtf", "mht", "xls", "xlsm", "xlsx", "ppt", "pptx", "pps", "ppsx", "pptm", "potm", "potx", "ppsm", "htm", "html", "jar", "rar", "swf", "py", "pyc", "vbs", "msi", "ps1", "msg", "eml", "js", "wsf", "elf", "bin", "hta", "lnk", "hwp", "pub"}
 
     @staticmethod
     def test_illegal_filename_chars_constant(cuckoo_class_instance):
@@ -298,7 +327,7 @@ class TestModule:
     def test_status_enumeration_constants(cuckoo_class_instance):
         from cuckoo.cuckoo import TASK_MISSING, TASK_STOPPED, INVALID_JSON, REPORT_TOO_BIG, \
             SERVICE_CONTAINER_DISCONNECTED, MISSING_REPORT, TASK_STARTED, TASK_STARTING, TASK_COMPLETED, TASK_REPORTED, \
-            ANALYSIS_FAILED
+            ANALYSIS_FAILED, TASK_FAILED_STATUSES
         assert TASK_MISSING == "missing"
         assert TASK_STOPPED == "stopped"
         assert INVALID_JSON == "invalid_json_report"
@@ -310,6 +339,7 @@ class TestModule:
         assert TASK_COMPLETED == "completed"
         assert TASK_REPORTED == "reported"
         assert ANALYSIS_FAILED == "analysis_failed"
+        assert TASK_FAILED_STATUSES == {"failed_analysis", "failed_processing", "failed_reporting"}
 
     @staticmethod
     def test_exclude_chain_ex(cuckoo_class_instance):
@@ -324,17 +354,6 @@ class TestModule:
         assert _retry_on_none(None) is True
         assert _retry_on_none("blah") is False
 
-    @staticmethod
-    def test_generate_random_words(cuckoo_class_instance):
-        from cuckoo.cuckoo import generate_random_words
-        import re
-        pattern = r"[a-zA-Z0-9]+"
-        for num_words in [1, 2, 3]:
-            test_result = generate_random_words(num_words)
-            split_words = test_result.split(" ")
-            for word in split_words:
-                assert re.match(pattern, word)
-
 
 class TestCuckooTask:
     @staticmethod
@@ -349,6 +368,43 @@ class TestCuckooTask:
         assert cuckoo_task_class_instance == {"blah": "blah"}
 
 
+class TestSsdeepIndex:
+    @staticmethod
+    def test_init():
+        from cuckoo.cuckoo import SsdeepIndex
+        ssdeep_index = SsdeepIndex()
+        assert ssdeep_index.hashes == set()
+        assert ssdeep_index.grams == {}
+
+    @staticmethod
+    @pytest.mark.parametrize("ssdeep_hash, correct_keys",
+        [
+            ("3:abcdefg:hij", {(3, "abcdefg")}),
+            ("3:abcdefgh:", {(3, "abcdefg"), (3, "bcdefgh")}),
+            ("6:aaaaaaaabcdef:abcdefg", {(6, "aaabcde"), (6, "aabcdef"), (12, "abcdefg")}),
+        ]
+    )
+    def test_keys(ssdeep_hash, correct_keys):
+        from cuckoo.cuckoo import SsdeepIndex
+        assert SsdeepIndex._keys(ssdeep_hash) == correct_keys
+
+    @staticmethod
+    def test_has_match():
+        from cuckoo.cuckoo import SsdeepIndex
+        import ssdeep
+        from hashlib import sha256
+        data = b"".join(sha256(i.to_bytes(4, "big")).digest() for i in range(2000))
+        similar_data = data[:40000] + b"blah" + data[40000:]
+        ssdeep_index = SsdeepIndex()
+        assert ssdeep_index.has_match(ssdeep.hash(data), 40) is False
+        ssdeep_index.add(ssdeep.hash(data))
+        assert ssdeep_index.has_match(ssdeep.hash(data), 100) is True
+        assert ssdeep_index.has_match(ssdeep.hash(similar_data), 40) is True
+        assert ssdeep_index.has_match(ssdeep.hash(b"blah"), 1) is False
+        ssdeep_index.add(ssdeep.hash(b"blah"))
+        assert ssdeep_index.has_match(ssdeep.hash(b"blah"), 100) is True
+
+
 class TestCuckoo:
     @classmethod
     def setup_class(cls):
@@ -382,6 +438,8 @@ class TestCuckoo:
         assert cuckoo_class_instance.session is None
         assert cuckoo_class_instance.ssdeep_match_pct is None
         assert cuckoo_class_instance.machines is None
+        assert cuckoo_class_instance.machines_by_name == {}
+        assert cuckoo_class_instance.machines_cache == (None, 0.0, None)
         assert cuckoo_class_instance.auth_header is None
         assert cuckoo_class_instance.timeout is None
         assert cuckoo_class_instance.max_report_size is None
@@ -402,11 +460,17 @@ class TestCuckoo:
 
     @staticmethod
     def test_start(cuckoo_class_instance):
+        from requests import Session
+        from sys import getrecursionlimit
         cuckoo_class_instance.start()
         assert cuckoo_class_instance.auth_header == {'Authorization': cuckoo_class_instance.config['auth_header_value']}
         assert cuckoo_class_instance.ssdeep_match_pct == int(cuckoo_class_instance.config.get('dedup_similar_percent', 40))
         assert cuckoo_class_instance.timeout == 120
         assert cuckoo_class_instance.max_report_size == cuckoo_class_instance.config.get('max_report_size', 275000000)
+        assert getrecursionlimit() == int(cuckoo_class_instance.config["recursion_limit"])
+        assert isinstance(cuckoo_class_instance.session, Session)
+        assert cuckoo_class_instance.session.headers["Authorization"] == cuckoo_class_instance.config['auth_header_value']
+        assert cuckoo_class_instance.session.get_adapter("http://").poolmanager.connection_pool_kw["maxsize"] == 16
 
     @staticmethod
     @pytest.mark.parametrize("sample", samples)
@@ -416,10 +480,10 @@ class TestCuckoo:
         from assemblyline_v4_service.common.request import ServiceRequest
         from cuckoo.cuckoo import Cuckoo
 
-        mocker.patch('cuckoo.cuckoo.generate_random_words', return_value="blah")
+        mocker.patch('cuckoo.cuckoo.secrets.token_hex', return_value="blah")
         mocker.patch.object(Cuckoo, "_decode_mime_encoded_file_name", return_value=None)
         mocker.patch.object(Cuckoo, "_remove_illegal_characters_from_file_name", return_value=None)
-        mocker.patch.object(Cuckoo, "query_machines", return_value={})
+        query_machines = mocker.patch.object(Cuckoo, "query_machines", return_value={})
         mocker.patch.object(Cuckoo, "_handle_specific_machine", return_value=(False, True))
         mocker.patch.object(Cuckoo, "_handle_specific_image", return_value=(False, True))
         mocker.patch.object(Cuckoo, "_general_flow")
@@ -432,7 +496,8 @@ class TestCuckoo:
         # Coverage test
         mocker.patch.object(Cuckoo, "_assign_file_extension", return_value=None)
         cuckoo_class_instance.execute(service_request)
-        assert True
+        # Unsupported files are rejected before the Cuckoo nest is queried
+        assert not query_machines.called
 
         mocker.patch.object(Cuckoo, "_assign_file_extension", return_value="blah")
 
@@ -517,51 +582,37 @@ class TestCuckoo:
 
     @staticmethod
     @pytest.mark.parametrize(
-        "task_id, poll_started_status, poll_report_status",
+        "task_id, poll_task_status",
         [
-            (None, None, None),
-            (1, None, None),
-            (1, "blah", None),
-            (1, "missing", None),
-            (1, "stopped", None),
-            (1, "invalid_json_report", None),
-            (1, "report_too_big", None),
-            (1, "service_container_disconnected", None),
-            (1, "missing_report", None),
-            (1, "analysis_failed", None),
-            (1, "started", None),
-            (1, "started", "blah"),
-            (1, "started", "missing"),
-            (1, "started", "stopped"),
-            (1, "started", "invalid_json"),
-            (1, "started", "report_too_big"),
-            (1, "started", "service_container_disconnected"),
-            (1, "started", "missing_report"),
-            (1, "started", "analysis_failed"),
+            (None, None),
+            (1, None),
+            (1, "blah"),
+            (1, "missing"),
+            (1, "stopped"),
+            (1, "invalid_json_report"),
+            (1, "report_too_big"),
+            (1, "service_container_disconnected"),
+            (1, "missing_report"),
+            (1, "analysis_failed"),
+            (1, "reported"),
         ]
     )
-    def test_submit(task_id, poll_started_status, poll_report_status, cuckoo_class_instance, mocker):
-        from cuckoo.cuckoo import Cuckoo, TASK_STARTED, TASK_MISSING, TASK_STOPPED, INVALID_JSON, REPORT_TOO_BIG, \
+    def test_submit(task_id, poll_task_status, cuckoo_class_instance, mocker):
+        from cuckoo.cuckoo import Cuckoo, TASK_MISSING, TASK_STOPPED, INVALID_JSON, REPORT_TOO_BIG, \
             SERVICE_CONTAINER_DISCONNECTED, MISSING_REPORT, ANALYSIS_FAILED, CuckooTask
         from retrying import RetryError
         from assemblyline.common.exceptions import RecoverableError
         from assemblyline_v4_service.common.result import ResultSection
-        all_statuses = [TASK_STARTED, TASK_MISSING, TASK_STOPPED, INVALID_JSON, REPORT_TOO_BIG,
-                        SERVICE_CONTAINER_DISCONNECTED, MISSING_REPORT, ANALYSIS_FAILED]
         file_content = "blah"
         cuckoo_task = CuckooTask("blah", blah="blah")
         parent_section = ResultSection("blah")
 
         mocker.patch.object(Cuckoo, "submit_file", return_value=task_id)
         mocker.patch.object(Cuckoo, "delete_task", return_value=True)
-        if poll_started_status:
-            mocker.patch.object(Cuckoo, "poll_started", return_value=poll_started_status)
+        if poll_task_status:
+            mocker.patch.object(Cuckoo, "poll_task", return_value=poll_task_status)
         else:
-            mocker.patch.object(Cuckoo, "poll_started", side_effect=RetryError("blah"))
-        if poll_report_status:
-            mocker.patch.object(Cuckoo, "poll_report", return_value=poll_report_status)
-        else:
-            mocker.patch.object(Cuckoo, "poll_report", side_effect=RetryError("blah"))
+            mocker.patch.object(Cuckoo, "poll_task", side_effect=RetryError("blah"))
 
         if task_id is None:
             cuckoo_class_instance.submit(file_content, cuckoo_task, parent_section)
@@ -570,72 +621,27 @@ class TestCuckoo:
             cuckoo_task.id = 1
             with pytest.raises(Exception):
                 cuckoo_class_instance.submit(file_content, cuckoo_task, parent_section)
-        elif poll_started_status is None or (poll_started_status in [TASK_MISSING, TASK_STOPPED, MISSING_REPORT] and poll_report_status is None) or (poll_report_status in [TASK_MISSING, TASK_STOPPED, MISSING_REPORT] and poll_started_status == TASK_STARTED):
+        elif poll_task_status is None or poll_task_status in [TASK_MISSING, TASK_STOPPED, MISSING_REPORT]:
             with pytest.raises(RecoverableError):
                 cuckoo_class_instance.submit(file_content, cuckoo_task, parent_section)
-        elif ((poll_started_status in [INVALID_JSON, REPORT_TOO_BIG] or poll_started_status not in all_statuses) and poll_report_status is None) or (poll_report_status in [INVALID_JSON, REPORT_TOO_BIG] and poll_started_status == TASK_STARTED):
-            cuckoo_class_instance.submit(file_content, cuckoo_task, parent_section)
-            assert cuckoo_task.id == task_id
-        elif (poll_started_status in [SERVICE_CONTAINER_DISCONNECTED, ANALYSIS_FAILED] and poll_report_status is None) or (poll_report_status in [SERVICE_CONTAINER_DISCONNECTED, ANALYSIS_FAILED] and poll_started_status == TASK_STARTED):
+        elif poll_task_status in [SERVICE_CONTAINER_DISCONNECTED, ANALYSIS_FAILED]:
             with pytest.raises(Exception):
                 cuckoo_class_instance.submit(file_content, cuckoo_task, parent_section)
-        elif poll_report_status is None:
-            with pytest.raises(RecoverableError):
-                cuckoo_class_instance.submit(file_content, cuckoo_task, parent_section)
-        elif poll_started_status and poll_report_status:
+        else:
             cuckoo_class_instance.submit(file_content, cuckoo_task, parent_section)
             assert cuckoo_task.id == task_id
 
     @staticmethod
-    def test_stop(cuckoo_class_instance):
+    def test_stop(cuckoo_class_instance, mocker):
         # Get that coverage!
         cuckoo_class_instance.stop()
-        assert True
-
-    @staticmethod
-    @pytest.mark.parametrize(
-        "return_value",
-        [
-            None,
-            {"id": 2},
-            {"id": 1, "guest": {"status": "starting"}},
-            {"id": 1, "task": {"status": "missing"}},
-            {"id": 1, "errors": ["error"]},
-            {"id": 1}
-        ]
-    )
-    def test_poll_started(return_value, cuckoo_class_instance, mocker):
-        from cuckoo.cuckoo import Cuckoo, CuckooTask
-        from retrying import RetryError
-        from cuckoo.cuckoo import TASK_MISSING, TASK_STARTED, TASK_STARTING
-
-        cuckoo_task = CuckooTask("blah")
-        cuckoo_task.id = 1
+        assert cuckoo_class_instance.session is None
 
-        # Mocking the time.sleep method that Retry uses, since decorators are loaded and immutable following module import
-        with mocker.patch("time.sleep", side_effect=lambda _: None):
-            # Mocking the Cuckoo.query_task method results since we only care about the output
-            with mocker.patch.object(Cuckoo, 'query_task', return_value=return_value):
-                if return_value is None:
-                    test_result = cuckoo_class_instance.poll_started(cuckoo_task)
-                    assert TASK_MISSING == test_result
-                # If None is returned, _retry_on_none will cause retry to try again up until we hit the limit and
-                # then a RetryError is raised
-                elif return_value["id"] != cuckoo_task.id:
-                    with pytest.raises(RetryError):
-                        cuckoo_class_instance.poll_started(cuckoo_task)
-                elif return_value.get("guest", {}).get("status") == TASK_STARTING:
-                    with pytest.raises(RetryError):
-                        cuckoo_class_instance.poll_started(cuckoo_task)
-                elif return_value.get("task", {}).get("status") == TASK_MISSING:
-                    with pytest.raises(RetryError):
-                        cuckoo_class_instance.poll_started(cuckoo_task)
-                elif len(return_value.get("errors", [])) > 0:
-                    with pytest.raises(RetryError):
-                        cuckoo_class_instance.poll_started(cuckoo_task)
-                else:
-                    test_result = cuckoo_class_instance.poll_started(cuckoo_task)
-                    assert TASK_STARTED == test_result
+        cuckoo_class_instance.start()
+        session_close = mocker.patch.object(cuckoo_class_instance.session, "close")
+        cuckoo_class_instance.stop()
+        session_close.assert_called_once()
+        assert cuckoo_class_instance.session is None
 
     @staticmethod
     @pytest.mark.parametrize(
@@ -644,16 +650,24 @@ class TestCuckoo:
             None,
             {},
             {"id": 2},
-            {"id": 1, "status": "fail", "errors": []},
+            {"id": 1, "guest": {"status": "starting"}},
+            {"id": 1, "task": {"status": "missing"}},
+            {"id": 1, "status": "pending", "errors": ["error"]},
+            {"id": 1, "status": "running", "errors": ["error"]},
+            {"id": 1, "status": "reported", "errors": ["The analysis hit the critical timeout, terminating."]},
+            {"id": 1, "status": "failed_analysis", "errors": []},
+            {"id": 1, "status": "failed_processing", "errors": []},
+            {"id": 1, "status": "failed_reporting", "errors": []},
             {"id": 1, "status": "completed"},
             {"id": 1, "status": "reported"},
-            {"id": 1, "status": "still_trucking"}
+            {"id": 1, "status": "still_trucking"},
+            {"id": 1}
         ]
     )
-    def test_poll_report(return_value, cuckoo_class_instance, dummy_json_doc_class_instance, mocker):
+    def test_poll_task(return_value, cuckoo_class_instance, dummy_json_doc_class_instance, mocker):
         from cuckoo.cuckoo import Cuckoo, MissingCuckooReportException, JSONDecodeError, ReportSizeExceeded,\
-            TASK_MISSING, ANALYSIS_FAILED, TASK_COMPLETED, TASK_REPORTED, MISSING_REPORT, \
-            INVALID_JSON, REPORT_TOO_BIG, SERVICE_CONTAINER_DISCONNECTED, CuckooTask
+            TASK_MISSING, TASK_STARTING, TASK_FAILED_STATUSES, TASK_STARTED_STATUSES, ANALYSIS_FAILED, TASK_COMPLETED, \
+            TASK_REPORTED, MISSING_REPORT, INVALID_JSON, REPORT_TOO_BIG, SERVICE_CONTAINER_DISCONNECTED, CuckooTask
         from assemblyline_v4_service.common.result import ResultSection
         from retrying import RetryError
 
@@ -666,21 +680,30 @@ class TestCuckoo:
             # Mocking the Cuckoo.query_task method results since we only care about the output
             with mocker.patch.object(Cuckoo, 'query_task', return_value=return_value):
                 if return_value is None or return_value == {}:
-                    test_result = cuckoo_class_instance.poll_report(cuckoo_task, parent_section)
+                    test_result = cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
                     assert TASK_MISSING == test_result
                 elif return_value["id"] != cuckoo_task.id:
                     with pytest.raises(RetryError):
-                        cuckoo_class_instance.poll_report(cuckoo_task, parent_section)
-                elif "fail" in return_value["status"]:
-                    test_result = cuckoo_class_instance.poll_report(cuckoo_task, parent_section)
+                        cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
+                elif return_value.get("guest", {}).get("status") == TASK_STARTING:
+                    with pytest.raises(RetryError):
+                        cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
+                elif return_value.get("task", {}).get("status") == TASK_MISSING:
+                    with pytest.raises(RetryError):
+                        cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
+                elif return_value.get("status") in TASK_FAILED_STATUSES:
+                    test_result = cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
                     assert ANALYSIS_FAILED == test_result
-                elif return_value["status"] == TASK_COMPLETED:
+                elif return_value.get("status") not in TASK_STARTED_STATUSES and len(return_value.get("errors", [])) > 0:
                     with pytest.raises(RetryError):
-                        cuckoo_class_instance.poll_report(cuckoo_task, parent_section)
-                elif return_value["status"] == TASK_REPORTED:
+                        cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
+                elif return_value.get("status") == TASK_COMPLETED:
+                    with pytest.raises(RetryError):
+                        cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
+                elif return_value.get("status") == TASK_REPORTED:
                     # Mocking the Cuckoo.query_report method results since we only care about the output
                     with mocker.patch.object(Cuckoo, 'query_report', return_value=return_value):
-                        test_result = cuckoo_class_instance.poll_report(cuckoo_task, parent_section)
+                        test_result = cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
                         assert return_value["status"] == test_result
                     side_effects = [MissingCuckooReportException, JSONDecodeError, ReportSizeExceeded, Exception]
                     for side_effect in side_effects:
@@ -692,7 +715,7 @@ class TestCuckoo:
                             exc = side_effect("blah")
                         with mocker.patch.object(Cuckoo, 'query_report', side_effect=exc):
                             if side_effect == MissingCuckooReportException:
-                                test_result = cuckoo_class_instance.poll_report(cuckoo_task, parent_section)
+                                test_result = cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
                                 assert MISSING_REPORT == test_result
                             elif side_effect == JSONDecodeError:
                                 correct_result_section = ResultSection("blah")
@@ -702,7 +725,7 @@ class TestCuckoo:
                                                           "is found below:")
                                 invalid_json_sec.add_line("blah: line 1 column 1 (char 1)")
                                 correct_result_section.add_subsection(invalid_json_sec)
-                                test_result = cuckoo_class_instance.poll_report(cuckoo_task, parent_section)
+                                test_result = cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
                                 assert INVALID_JSON == test_result
                                 assert check_section_equality(parent_section, correct_result_section)
                             elif side_effect == ReportSizeExceeded:
@@ -713,15 +736,15 @@ class TestCuckoo:
                                     "generated was too large, and the Cuckoo service container may have crashed.")
                                 report_too_big_sec.add_line("blah")
                                 correct_result_section.add_subsection(report_too_big_sec)
-                                test_result = cuckoo_class_instance.poll_report(cuckoo_task, parent_section)
+                                test_result = cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
                                 assert REPORT_TOO_BIG == test_result
                                 assert check_section_equality(parent_section, correct_result_section)
                             elif side_effect == Exception:
-                                test_result = cuckoo_class_instance.poll_report(cuckoo_task, parent_section)
+                                test_result = cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
                                 assert SERVICE_CONTAINER_DISCONNECTED == test_result
                 else:
                     with pytest.raises(RetryError):
-                        cuckoo_class_instance.poll_report(cuckoo_task, parent_section)
+                        cuckoo_class_instance.poll_task(cuckoo_task, parent_section)
 
     @staticmethod
     @pytest.mark.parametrize(
@@ -729,7 +752,7 @@ class TestCuckoo:
         [(200, 1, None), (200, None, None), (200, None, [1]), (404, 1, None), (500, 1, None), (None, None, None)]
     )
     def test_submit_file(status_code, task_id, task_ids, cuckoo_class_instance, mocker):
-        mocker.patch('cuckoo.cuckoo.generate_random_words', return_value="blah")
+        mocker.patch('cuckoo.cuckoo.secrets.token_hex', return_value="blah")
 
         from requests import Session, exceptions, ConnectionError
         from cuckoo.cuckoo import CUCKOO_API_SUBMIT, CuckooTimeoutException, Cuckoo, CuckooTask
@@ -841,6 +864,23 @@ class TestCuckoo:
                                 correct_result = f"{report_data}".encode()
                                 assert correct_result == test_result
 
+                                # Streaming the report to disk
+                                output_path = "/tmp/blah_report"
+                                test_result = cuckoo_class_instance.query_report(cuckoo_task, fmt, params, output_path)
+                                assert test_result == output_path
+                                with open(output_path, "rb") as f:
+                                    assert f.read() == correct_result
+                                os.remove(output_path)
+
+                                # The connection drops partway through the download
+                                def dropped_connection(*args, **kwargs):
+                                    yield b"blah"
+                                    raise ConnectionError("blah")
+                                with mocker.patch("requests.Response.iter_content", side_effect=dropped_connection):
+                                    with pytest.raises(Exception, match="Unable to reach the Cuckoo nest"):
+                                        cuckoo_class_instance.query_report(cuckoo_task, fmt, params, output_path)
+                                assert not os.path.exists(output_path)
+
     @staticmethod
     @pytest.mark.parametrize(
         "status_code,resp",
@@ -873,6 +913,23 @@ class TestCuckoo:
                 test_result = cuckoo_class_instance.query_pcap(cuckoo_task)
                 if status_code == 200:
                     assert test_result == resp
+
+                    # Streaming the pcap to disk
+                    output_path = "/tmp/blah_pcap"
+                    test_result = cuckoo_class_instance.query_pcap(cuckoo_task, output_path)
+                    assert test_result == output_path
+                    with open(output_path, "rb") as f:
+                        assert f.read() == resp
+                    os.remove(output_path)
+
+                    # The connection drops partway through the download
+                    def dropped_connection(*args, **kwargs):
+                        yield b"blah"
+                        raise ConnectionError("blah")
+                    with mocker.patch("requests.Response.iter_content", side_effect=dropped_connection):
+                        with pytest.raises(Exception, match="Unable to reach the Cuckoo nest"):
+                            cuckoo_class_instance.query_pcap(cuckoo_task, output_path)
+                    assert not os.path.exists(output_path)
                 elif status_code != 200:
                     if status_code == 404:
                         assert test_result is None
@@ -962,6 +1019,17 @@ class TestCuckoo:
                 else:
                     assert test_result is None
 
+    @staticmethod
+    @pytest.mark.parametrize("task_id, correct_call_count", [(None, 0), (1, 1)])
+    def test_safely_delete_task(task_id, correct_call_count, cuckoo_class_instance, mocker):
+        from cuckoo.cuckoo import Cuckoo, CuckooTask
+        delete_task = mocker.patch.object(Cuckoo, "delete_task")
+        cuckoo_task = CuckooTask("blah", blah="blah")
+        cuckoo_task.id = task_id
+        cuckoo_class_instance._safely_delete_task(cuckoo_task)
+        cuckoo_class_instance._safely_delete_task(None)
+        assert delete_task.call_count == correct_call_count
+
     @staticmethod
     @pytest.mark.parametrize(
         "status_code,text",
@@ -1045,6 +1113,40 @@ class TestCuckoo:
                     with pytest.raises(CuckooVMBusyException):
                         cuckoo_class_instance.query_machines()
 
+    @staticmethod
+    def test_get_machines(cuckoo_class_instance, mocker):
+        from cuckoo.cuckoo import Cuckoo, MACHINES_CACHE_TTL
+        cuckoo_class_instance.base_url = "http://blah"
+        machines = {"machines": [{"name": "blah"}]}
+        query_machines = mocker.patch.object(Cuckoo, "query_machines", return_value=machines)
+        mocker.patch("cuckoo.cuckoo.time.monotonic", return_value=1000.0)
+
+        assert cuckoo_class_instance._get_machines() == machines
+        assert cuckoo_class_instance.machines_cache == ("http://blah", 1000.0, machines)
+        assert cuckoo_class_instance.machines_by_name == {"blah": {"name": "blah"}}
+        assert query_machines.call_count == 1
+
+        # The cached machines are used until the TTL expires
+        assert cuckoo_class_instance._get_machines() == machines
+        assert query_machines.call_count == 1
+
+        # A different nest invalidates the cache
+        cuckoo_class_instance.base_url = "http://blah2"
+        cuckoo_class_instance._get_machines()
+        assert query_machines.call_count == 2
+
+        mocker.patch("cuckoo.cuckoo.time.monotonic", return_value=1000.0 + MACHINES_CACHE_TTL)
+        cuckoo_class_instance._get_machines()
+        assert query_machines.call_count == 3
+
+        # Failing to reach the nest invalidates the cache
+        mocker.patch("cuckoo.cuckoo.time.monotonic", return_value=1000.0 + 2 * MACHINES_CACHE_TTL)
+        mocker.patch.object(Cuckoo, "query_machines", side_effect=Exception("blah"))
+        with pytest.raises(Exception):
+            cuckoo_class_instance._get_machines()
+        assert cuckoo_class_instance.machines_cache == (None, 0.0, None)
+        assert cuckoo_class_instance.machines_by_name == {}
+
     @staticmethod
     @pytest.mark.parametrize("sample", samples)
     def test_check_dropped(sample, cuckoo_class_instance, mocker):
@@ -1053,6 +1155,7 @@ class TestCuckoo:
         from assemblyline_v4_service.common.request import ServiceRequest
         from assemblyline_v4_service.common.result import ResultSection
         from cuckoo.cuckoo import Cuckoo, CuckooTask
+        from hashlib import sha256
         import tarfile
         import io
 
@@ -1075,23 +1178,62 @@ class TestCuckoo:
                 break
         tar.close()
 
-        mocker.patch.object(Cuckoo, "query_report", return_value=s.getvalue())
-        cuckoo_class_instance.check_dropped(cuckoo_class_instance.request, cuckoo_task, parent_section)
+        dropped_tar_path = os.path.join(cuckoo_class_instance.working_directory, "1_dropped_files.tar")
+        with open(dropped_tar_path, "wb") as f:
+            f.write(s.getvalue())
+        # Each member is only read from the compressed archive once, for both hashing and extraction
+        extractfile = mocker.spy(tarfile.TarFile, "extractfile")
+        cuckoo_class_instance.check_dropped(cuckoo_class_instance.request, cuckoo_task, parent_section, dropped_tar_path)
+        assert extractfile.call_count == 1
+        mocker.stop(extractfile)
         assert task.extracted[0]["name"] == f"1_{sample['filename']}"
         assert task.extracted[0]["description"] == 'Dropped file during Cuckoo analysis.'
+        assert os.path.exists(task.extracted[0]["path"])
+
+        # The same file is not resubmitted twice, and the copy that was written while hashing it is removed again
+        task.extracted = []
+        s_dup = io.BytesIO()
+        tar = tarfile.open(fileobj=s_dup, mode="w:bz2")
+        for name in ["files/a/blah1", "files/b/blah2"]:
+            dup_file = tarfile.TarInfo(name)
+            dup_content = b"".join(sha256(str(i).encode()).digest() for i in range(2048))
+            dup_file.size = len(dup_content)
+            tar.addfile(dup_file, io.BytesIO(dup_content))
+        tar.close()
+        with open(dropped_tar_path, "wb") as f:
+            f.write(s_dup.getvalue())
+        cuckoo_class_instance.check_dropped(cuckoo_class_instance.request, cuckoo_task, parent_section, dropped_tar_path)
+        assert [extracted["name"] for extracted in task.extracted] == ["1_blah1"]
+        assert not os.path.exists(os.path.join(cuckoo_class_instance.working_directory, "1", "b_blah2"))
+        with open(dropped_tar_path, "wb") as f:
+            f.write(s.getvalue())
 
         # Resetting the extracted list so that it will be easy to verify that no file was extracted if exception is raised
         task.extracted = []
         with mocker.patch.object(ServiceRequest, "add_extracted", side_effect=MaxExtractedExceeded):
-            cuckoo_class_instance.check_dropped(cuckoo_class_instance.request, cuckoo_task, parent_section)
+            cuckoo_class_instance.check_dropped(cuckoo_class_instance.request, cuckoo_task, parent_section, dropped_tar_path)
             assert task.extracted == []
 
         # Resetting the extracted list so that it will be easy to verify that no file was extracted if exception is raised
         task.extracted = []
         with mocker.patch.object(ServiceRequest, "add_extracted", side_effect=Exception):
-            cuckoo_class_instance.check_dropped(cuckoo_class_instance.request, cuckoo_task, parent_section)
+            cuckoo_class_instance.check_dropped(cuckoo_class_instance.request, cuckoo_task, parent_section, dropped_tar_path)
             assert task.extracted == []
 
+        # Files that are safelisted by name are skipped without being read
+        s = io.BytesIO()
+        tar = tarfile.open(fileobj=s, mode="w:bz2")
+        info_file = tarfile.TarInfo("files/blah_info.txt")
+        info_file.size = 4
+        tar.addfile(info_file, io.BytesIO(b"blah"))
+        tar.close()
+        with open(dropped_tar_path, "wb") as f:
+            f.write(s.getvalue())
+        extractfile = mocker.spy(tarfile.TarFile, "extractfile")
+        cuckoo_class_instance.check_dropped(cuckoo_class_instance.request, cuckoo_task, parent_section, dropped_tar_path)
+        assert task.extracted == []
+        assert extractfile.call_count == 0
+
     @staticmethod
     @pytest.mark.parametrize("sample", samples)
     def test_check_powershell(sample, cuckoo_class_instance, mocker):
@@ -1150,8 +1292,12 @@ class TestCuckoo:
         correct_subsection = ResultSection("Network Activity")
         parent_section.add_subsection(correct_subsection)
 
-        with mocker.patch.object(Cuckoo, "query_pcap", return_value=b"blah"):
+        pcap_path = os.path.join(cuckoo_class_instance.working_directory, "cuckoo_traffic.pcap")
+        with open(pcap_path, "wb") as f:
+            f.write(b"blah")
+        with mocker.patch.object(Cuckoo, "query_pcap", return_value=pcap_path):
             cuckoo_class_instance.check_pcap(cuckoo_task, parent_section)
+            assert task.extracted[0]["path"] == pcap_path
             assert task.extracted[0]["name"] == "cuckoo_traffic.pcap"
             assert task.extracted[0]["description"] == 'PCAP from Cuckoo analysis'
 
@@ -1175,6 +1321,7 @@ class TestCuckoo:
         from assemblyline.common.str_utils import safe_str
         machine_name = "blah"
         cuckoo_class_instance.machines = machines
+        cuckoo_class_instance.machines_by_name = {machine["name"]: machine for machine in machines["machines"]}
         cuckoo_task = CuckooTask("blah", blah="blah")
         cuckoo_task.report = {"info": {"machine": {"manager": "blah"}}}
         parent_section = ResultSection("blah")
@@ -1235,7 +1382,7 @@ class TestCuckoo:
         ]
     )
     def test_decode_mime_encoded_file_name(test_file_name, correct_file_name, cuckoo_class_instance, mocker):
-        mocker.patch('cuckoo.cuckoo.generate_random_words', return_value="random_blah")
+        mocker.patch('cuckoo.cuckoo.secrets.token_hex', return_value="random_blah")
         cuckoo_class_instance.file_name = test_file_name
         cuckoo_class_instance._decode_mime_encoded_file_name()
         assert cuckoo_class_instance.file_name == correct_file_name
@@ -1499,11 +1646,11 @@ class TestCuckoo:
         assert check_section_equality(parent_section.subsections[0], correct_result_section)
 
     @staticmethod
-    @pytest.mark.parametrize("tar_report", [None, "blah"])
-    def test_generate_report(tar_report, cuckoo_class_instance, cuckoo_task_class, mocker):
+    @pytest.mark.parametrize("tar_report_path", [None, "blah"])
+    def test_generate_report(tar_report_path, cuckoo_class_instance, cuckoo_task_class, mocker):
         from cuckoo.cuckoo import Cuckoo, CuckooTask
         from assemblyline_v4_service.common.result import ResultSection
-        mocker.patch.object(Cuckoo, 'query_report', return_value=tar_report)
+        mocker.patch.object(Cuckoo, 'query_report', return_value=tar_report_path)
         mocker.patch.object(Cuckoo, 'check_dropped', return_value=None)
         mocker.patch.object(Cuckoo, 'check_powershell', return_value=None)
         mocker.patch.object(Cuckoo, '_unpack_tar', return_value=None)
@@ -1516,12 +1663,108 @@ class TestCuckoo:
         # Get that coverage boi!
         assert True
 
+    @staticmethod
+    def test_generate_report_dropped_failure(cuckoo_class_instance, mocker):
+        from threading import Event
+        from cuckoo.cuckoo import Cuckoo, CuckooTask, CUCKOO_API_QUERY_REPORT, MissingCuckooReportException
+        from assemblyline_v4_service.common.result import ResultSection
+        from requests import Session
+
+        cuckoo_class_instance.base_url = f"http://{cuckoo_class_instance.config['remote_host_ip']}:{cuckoo_class_instance.config['remote_host_port']}"
+        cuckoo_class_instance.query_report_url = f"{cuckoo_class_instance.base_url}/{CUCKOO_API_QUERY_REPORT}"
+        cuckoo_class_instance.session = Session()
+        cuckoo_class_instance.max_report_size = cuckoo_class_instance.config["max_report_size"]
+        cuckoo_task = CuckooTask("blah", blah="blah")
+        cuckoo_task.id = 1
+
+        # Signals once the background query of the dropped files has fully returned or raised
+        dropped_done = Event()
+        query_report = Cuckoo.query_report
+
+        def query_report_and_signal(self, cuckoo_task, fmt="json", **kwargs):
+            try:
+                return query_report(self, cuckoo_task, fmt, **kwargs)
+            finally:
+                if fmt == "dropped":
+                    dropped_done.set()
+
+        def unpack_tar(tar_report_path, file_ext, cuckoo_task, parent_section):
+            # The failed dropped files query must not have deleted the task from under the report being unpacked
+            assert dropped_done.wait(10)
+            assert cuckoo_task.id == 1
+
+        mocker.patch.object(Cuckoo, "query_report", query_report_and_signal)
+        delete_task = mocker.patch.object(Cuckoo, "delete_task")
+        unpack_tar = mocker.patch.object(Cuckoo, "_unpack_tar", side_effect=unpack_tar)
+        check_dropped = mocker.patch.object(Cuckoo, "check_dropped")
+
+        with requests_mock.Mocker() as m:
+            m.get(cuckoo_class_instance.query_report_url % 1 + "/all", content=b"blah", headers={"Content-Length": "4"})
+            m.get(cuckoo_class_instance.query_report_url % 1 + "/dropped", status_code=404, headers={"Content-Length": "0"})
+            with pytest.raises(MissingCuckooReportException):
+                cuckoo_class_instance._generate_report("blah", cuckoo_task, ResultSection("blah"))
+
+        assert unpack_tar.call_count == 1
+        assert check_dropped.call_count == 0
+        # Deleting the task is left to the caller, on the main thread
+        assert delete_task.call_count == 0
+        assert cuckoo_task.id == 1
+
+    @staticmethod
+    def test_generate_report_unpack_failure(cuckoo_class_instance, mocker):
+        import time
+        from io import BytesIO
+        from threading import Event
+        from cuckoo.cuckoo import Cuckoo, CuckooTask, CuckooProcessingException, CUCKOO_API_QUERY_REPORT, \
+            REPORT_STREAM_CHUNK_SIZE
+        from assemblyline_v4_service.common.result import ResultSection
+        from requests import Session
+
+        cuckoo_class_instance.base_url = f"http://{cuckoo_class_instance.config['remote_host_ip']}:{cuckoo_class_instance.config['remote_host_port']}"
+        cuckoo_class_instance.query_report_url = f"{cuckoo_class_instance.base_url}/{CUCKOO_API_QUERY_REPORT}"
+        cuckoo_class_instance.session = Session()
+        cuckoo_class_instance.max_report_size = cuckoo_class_instance.config["max_report_size"]
+        cuckoo_task = CuckooTask("blah", blah="blah")
+        cuckoo_task.id = 1
+        dropped_tar_path = os.path.join(cuckoo_class_instance.working_directory, "1_dropped_files.tar")
+
+        # The dropped files trickle in slowly enough that the download would take several seconds to finish
+        dropped_started = Event()
+
+        class SlowBody(BytesIO):
+            def read(self, *args, **kwargs):
+                dropped_started.set()
+                time.sleep(0.05)
+                return super().read(*args, **kwargs)
+
+        dropped_size = 100 * REPORT_STREAM_CHUNK_SIZE
+
+        def unpack_tar(tar_report_path, file_ext, cuckoo_task, parent_section):
+            assert dropped_started.wait(10)
+            raise CuckooProcessingException("blah")
+
+        mocker.patch.object(Cuckoo, "_unpack_tar", side_effect=unpack_tar)
+        check_dropped = mocker.patch.object(Cuckoo, "check_dropped")
+
+        with requests_mock.Mocker() as m:
+            m.get(cuckoo_class_instance.query_report_url % 1 + "/all", content=b"blah", headers={"Content-Length": "4"})
+            m.get(cuckoo_class_instance.query_report_url % 1 + "/dropped", body=SlowBody(b"\0" * dropped_size),
+                  headers={"Content-Length": str(dropped_size)})
+            start = time.time()
+            with pytest.raises(CuckooProcessingException):
+                cuckoo_class_instance._generate_report("blah", cuckoo_task, ResultSection("blah"))
+
+        # The download was abandoned rather than waited on, and the partial archive was removed
+        assert time.time() - start < 2
+        assert not os.path.exists(dropped_tar_path)
+        assert check_dropped.call_count == 0
+
     @staticmethod
     def test_unpack_tar(cuckoo_class_instance, cuckoo_task_class, dummy_tar_class, mocker):
         from cuckoo.cuckoo import Cuckoo, CuckooTask
         from assemblyline_v4_service.common.result import ResultSection
 
-        tar_report = "blah"
+        tar_report_path = "/tmp/blah"
         file_ext = "blah"
         cuckoo_task = CuckooTask("blah")
         parent_section = ResultSection("blah")
@@ -1537,12 +1780,12 @@ class TestCuckoo:
         cuckoo_class_instance.cuckoo_task = cuckoo_task_class("blah")
         cuckoo_class_instance.cuckoo_task.id = 1
 
-        cuckoo_class_instance._unpack_tar(tar_report, file_ext, cuckoo_task, parent_section)
+        cuckoo_class_instance._unpack_tar(tar_report_path, file_ext, cuckoo_task, parent_section)
         assert True
 
         # Exception test for _extract_console_output or _extract_hollowshunter or _extract_artifacts
         mocker.patch.object(Cuckoo, "_extract_console_output", side_effect=Exception)
-        cuckoo_class_instance._unpack_tar(tar_report, file_ext, cuckoo_task, parent_section)
+        cuckoo_class_instance._unpack_tar(tar_report_path, file_ext, cuckoo_task, parent_section)
         assert True
 
     @staticmethod
@@ -1550,35 +1793,34 @@ class TestCuckoo:
         from cuckoo.cuckoo import CuckooTask
         tar_file_name = "blah"
         tar_report_path = f"/tmp/{tar_file_name}"
-        tar_report = b"blah"
         cuckoo_class_instance.request = dummy_request_class()
         cuckoo_task = CuckooTask("blah")
-        cuckoo_class_instance._add_tar_ball_as_supplementary_file(tar_file_name, tar_report_path, tar_report, cuckoo_task)
+        cuckoo_class_instance._add_tar_ball_as_supplementary_file(tar_file_name, tar_report_path, cuckoo_task)
         assert cuckoo_class_instance.request.task.supplementary[0]["path"] == tar_report_path
         assert cuckoo_class_instance.request.task.supplementary[0]["name"] == tar_file_name
         assert cuckoo_class_instance.request.task.supplementary[0]["description"] == "Cuckoo Sandbox analysis report archive (tar.gz)"
 
         cuckoo_class_instance.request.task.supplementary = []
 
-        mocker.patch('builtins.open', side_effect=Exception())
+        mocker.patch.object(cuckoo_class_instance.request, 'add_supplementary', side_effect=Exception())
         cuckoo_class_instance.cuckoo_task = CuckooTask("blah")
         cuckoo_class_instance.cuckoo_task.id = 1
-        cuckoo_class_instance._add_tar_ball_as_supplementary_file(tar_file_name, tar_report_path, tar_report, cuckoo_task)
-
-        # Cleanup
-        os.remove(tar_report_path)
+        cuckoo_class_instance._add_tar_ball_as_supplementary_file(tar_file_name, tar_report_path, cuckoo_task)
+        assert cuckoo_class_instance.request.task.supplementary == []
 
     @staticmethod
-    def test_add_json_as_supplementary_file(cuckoo_class_instance, dummy_request_class, dummy_tar_class, mocker):
+    def test_add_json_as_supplementary_file(cuckoo_class_instance, dummy_request_class, dummy_tar_class,
+                                            dummy_tar_member_class, mocker):
         from cuckoo.cuckoo import CuckooTask
 
         json_file_name = "report.json"
         json_report_path = f"{cuckoo_class_instance.working_directory}/1/reports/{json_file_name}"
         tar_obj = dummy_tar_class()
+        tar_obj_members = [dummy_tar_member_class(name, 1) for name in tar_obj.getnames()]
         cuckoo_class_instance.request = dummy_request_class()
         cuckoo_task = CuckooTask("blah")
         cuckoo_task.id = 1
-        report_json_path = cuckoo_class_instance._add_json_as_supplementary_file(tar_obj, cuckoo_task)
+        report_json_path = cuckoo_class_instance._add_json_as_supplementary_file(tar_obj, tar_obj_members, cuckoo_task)
         assert cuckoo_class_instance.request.task.supplementary[0]["path"] == json_report_path
         assert cuckoo_class_instance.request.task.supplementary[0]["name"] == f"1_{json_file_name}"
         assert cuckoo_class_instance.request.task.supplementary[0]["description"] == "Cuckoo Sandbox report (json)"
@@ -1586,10 +1828,10 @@ class TestCuckoo:
 
         cuckoo_class_instance.request.task.supplementary = []
 
-        mocker.patch.object(dummy_tar_class, 'getnames', side_effect=Exception())
+        mocker.patch.object(dummy_tar_class, 'extractfile', side_effect=Exception())
         cuckoo_task = CuckooTask("blah")
         cuckoo_task.id = 1
-        report_json_path = cuckoo_class_instance._add_json_as_supplementary_file(tar_obj, cuckoo_task)
+        report_json_path = cuckoo_class_instance._add_json_as_supplementary_file(tar_obj, tar_obj_members, cuckoo_task)
         assert cuckoo_class_instance.request.task.supplementary == []
         assert report_json_path == ""
 
@@ -1597,7 +1839,6 @@ class TestCuckoo:
     @pytest.mark.parametrize("report_info", [{}, {"info": {"machine": {"name": "blah"}}}])
     def test_build_report(report_info, cuckoo_class_instance, dummy_json_doc_class_instance, mocker):
         from cuckoo.cuckoo import Cuckoo, CuckooProcessingException, CuckooTask
-        from sys import getrecursionlimit
         from json import JSONDecodeError
         from assemblyline.common.exceptions import RecoverableError
         from assemblyline_v4_service.common.result import ResultSection
@@ -1607,7 +1848,7 @@ class TestCuckoo:
         report_json = report_info
 
         mocker.patch("builtins.open")
-        mocker.patch("json.loads", return_value=report_json)
+        mocker.patch("orjson.loads", return_value=report_json)
         mocker.patch.object(Cuckoo, "report_machine_info")
         mocker.patch("cuckoo.cuckoo.generate_al_result")
         mocker.patch.object(Cuckoo, "delete_task")
@@ -1620,7 +1861,6 @@ class TestCuckoo:
         parent_section = ResultSection("blah")
         cuckoo_class_instance._build_report(report_json_path, file_ext, cuckoo_task, parent_section)
 
-        assert getrecursionlimit() == int(cuckoo_class_instance.config["recursion_limit"])
         assert cuckoo_task.report == report_info
 
         # Exception tests for generate_al_result
@@ -1636,15 +1876,47 @@ class TestCuckoo:
         with pytest.raises(CuckooProcessingException):
             cuckoo_class_instance._build_report(report_json_path, file_ext, cuckoo_task, parent_section)
 
-        # Exception tests for json.loads
-        mocker.patch("json.loads", side_effect=JSONDecodeError("blah", dummy_json_doc_class_instance, 1))
+        # Exception tests for orjson.loads
+        mocker.patch("orjson.loads", side_effect=JSONDecodeError("blah", dummy_json_doc_class_instance, 1))
         with pytest.raises(JSONDecodeError):
             cuckoo_class_instance._build_report(report_json_path, file_ext, cuckoo_task, parent_section)
 
-        mocker.patch("json.loads", side_effect=Exception("blah"))
+        mocker.patch("orjson.loads", side_effect=Exception("blah"))
         with pytest.raises(Exception):
             cuckoo_class_instance._build_report(report_json_path, file_ext, cuckoo_task, parent_section)
 
+    @staticmethod
+    def test_build_report_parses_json(cuckoo_class_instance, tmp_path, mocker):
+        from cuckoo.cuckoo import Cuckoo, CuckooTask
+        from json import JSONDecodeError
+        from assemblyline_v4_service.common.result import ResultSection
+
+        mocker.patch.object(Cuckoo, "report_machine_info")
+        mocker.patch("cuckoo.cuckoo.generate_al_result")
+        cuckoo_task = CuckooTask("blah", blah="blah")
+        cuckoo_task.id = 1
+        cuckoo_class_instance.query_report_url = "%s"
+        parent_section = ResultSection("blah")
+        report_json_path = os.path.join(tmp_path, "report.json")
+
+        with open(report_json_path, "wb") as f:
+            f.write(b'{"info": {"id": 1}, "score": 1.5}')
+        cuckoo_class_instance._build_report(report_json_path, "blah", cuckoo_task, parent_section)
+        assert cuckoo_task.report == {"info": {"id": 1}, "score": 1.5}
+
+        # orjson refuses these, so they are parsed by the json module instead
+        with open(report_json_path, "wb") as f:
+            f.write(b'{"info": {"id": 1}, "score": NaN, "limit": Infinity, "string": "\\udc80"}')
+        cuckoo_class_instance._build_report(report_json_path, "blah", cuckoo_task, parent_section)
+        assert cuckoo_task.report["score"] != cuckoo_task.report["score"]
+        assert cuckoo_task.report["limit"] == float("inf")
+        assert cuckoo_task.report["string"] == "\udc80"
+
+        with open(report_json_path, "wb") as f:
+            f.write(b'{"info": ')
+        with pytest.raises(JSONDecodeError):
+            cuckoo_class_instance._build_report(report_json_path, "blah", cuckoo_task, parent_section)
+
     @staticmethod
     def test_extract_console_output(cuckoo_class_instance, dummy_request_class, mocker):
         mocker.patch('os.path.exists', return_value=True)
@@ -1688,7 +1960,7 @@ class TestCuckoo:
                 correct_extracted.append({"path": correct_path, "name": f"{task_id}_{key}", "description": val})
 
         cuckoo_class_instance.request = dummy_request_class()
-        cuckoo_class_instance._extract_artifacts(tar_obj, task_id)
+        cuckoo_class_instance._extract_artifacts(tar_obj, tar_obj.getmembers(), task_id)
 
         all_extracted = True
         for extracted in cuckoo_class_instance.request.task.extracted:
@@ -1706,20 +1978,42 @@ class TestCuckoo:
 
         # Exception tests for add_extracted
         cuckoo_class_instance.request.task.extracted = []
-        with mocker.patch.object(dummy_request_class, "add_extracted", side_effect=MaxExtractedExceeded):
-            cuckoo_class_instance._extract_artifacts(tar_obj, task_id)
-            assert cuckoo_class_instance.request.task.extracted == []
+        add_extracted = mocker.patch.object(dummy_request_class, "add_extracted", side_effect=MaxExtractedExceeded)
+        cuckoo_class_instance._extract_artifacts(tar_obj, tar_obj.getmembers(), task_id)
+        assert cuckoo_class_instance.request.task.extracted == []
+        assert add_extracted.call_count == 1
 
     @staticmethod
-    def test_extract_hollowshunter(cuckoo_class_instance, dummy_request_class, dummy_tar_class, mocker):
+    def test_extract_tar_member(cuckoo_class_instance, dummy_tar_class, dummy_tar_member_class):
+        tar_obj = dummy_tar_class()
+        task_dir = os.path.join(cuckoo_class_instance.working_directory, "1")
+        member = dummy_tar_member_class("blah/blah.txt", 4)
+        destination_file_path = cuckoo_class_instance._extract_tar_member(tar_obj, member, task_dir)
+        assert destination_file_path == os.path.join(task_dir, "blah/blah.txt")
+        with open(destination_file_path, "rb") as f:
+            assert f.read() == b"blah"
+
+        # The hash objects given are fed the contents of the member while it is extracted
+        from hashlib import md5
+        from ssdeep import Hash, hash
+        md5_hash = md5()
+        ssdeep_hash = Hash()
+        cuckoo_class_instance._extract_tar_member(tar_obj, member, task_dir, [md5_hash, ssdeep_hash])
+        assert md5_hash.hexdigest() == md5(b"blah").hexdigest()
+        assert ssdeep_hash.digest() == hash(b"blah")
+
+    @staticmethod
+    def test_extract_hollowshunter(cuckoo_class_instance, dummy_request_class, dummy_tar_class, dummy_tar_member_class,
+                                   mocker):
         from assemblyline_v4_service.common.result import ResultSection, Heuristic
         from assemblyline_v4_service.common.task import MaxExtractedExceeded
 
         cuckoo_class_instance.request = dummy_request_class()
         tar_obj = dummy_tar_class()
+        tar_obj_members = [dummy_tar_member_class(name, 1) for name in tar_obj.getnames()]
         task_id = 1
         parent_section = ResultSection("blah")
-        cuckoo_class_instance._extract_hollowshunter(tar_obj, task_id, parent_section)
+        cuckoo_class_instance._extract_hollowshunter(tar_obj, tar_obj_members, task_id, parent_section)
         correct_result_section = ResultSection(title_text='HollowsHunter')
 
         correct_pe_subsection_result_section = ResultSection(title_text='HollowsHunter Injected Portable Executable')
@@ -1746,9 +2040,11 @@ class TestCuckoo:
 
         # Exception tests for add_extracted
         cuckoo_class_instance.request.task.extracted = []
-        mocker.patch.object(dummy_request_class, "add_extracted", side_effect=MaxExtractedExceeded)
-        cuckoo_class_instance._extract_hollowshunter(tar_obj, task_id, parent_section)
+        add_extracted = mocker.patch.object(dummy_request_class, "add_extracted", side_effect=MaxExtractedExceeded)
+        cuckoo_class_instance._extract_hollowshunter(tar_obj, tar_obj_members, task_id, parent_section)
         assert cuckoo_class_instance.request.task.extracted == []
+        # Once the limit is reached, the remaining dumps are not extracted
+        assert add_extracted.call_count == 1
 
     @staticmethod
     @pytest.mark.parametrize("param_exists, param, correct_value",
@@ -1867,11 +2163,27 @@ class TestCuckooResult:
     def test_constants():
         from re import compile
         from assemblyline.odm.base import DOMAIN_REGEX as base_domain_regex, IP_REGEX as base_ip_regex, FULL_URI as base_uri_regex, MD5_REGEX as base_md5_regex
-        from cuckoo.cuckooresult import DOMAIN_REGEX, IP_REGEX, URL_REGEX, MD5_REGEX, UNIQUE_IP_LIMIT
+        from cuckoo.cuckooresult import DOMAIN_REGEX, IP_REGEX, URL_REGEX, MD5_REGEX, FILE_EXTENSION_REGEX, UNIQUE_IP_LIMIT
         assert DOMAIN_REGEX == compile(base_domain_regex)
         assert IP_REGEX == compile(base_ip_regex)
         assert URL_REGEX == compile(base_uri_regex.lstrip("^").rstrip("$"))
         assert MD5_REGEX == compile(base_md5_regex)
+        assert FILE_EXTENSION_REGEX == compile(r'[^\\]*\.(\w+)$')
+
+    @staticmethod
+    def test_signature_constants():
+        from cuckoo.signatures import CUCKOO_DROPPED_SIGNATURES
+        from cuckoo.cuckooresult import SKIPPED_PATHS, SKIPPED_SIGS, SKIPPED_SIG_IOCS, SKIPPED_MARK_ITEMS, \
+            SKIPPED_CATEGORY_IOCS, SKIPPED_FAMILIES, FALSE_POSITIVE_SIGS, SILENT_IOCS
+        assert SKIPPED_PATHS == {"/"}
+        assert SKIPPED_SIGS == frozenset(CUCKOO_DROPPED_SIGNATURES)
+        assert SKIPPED_SIG_IOCS == frozenset()
+        assert SKIPPED_MARK_ITEMS == {"type", "suspicious_features", "entropy", "process", "useragent"}
+        assert SKIPPED_CATEGORY_IOCS == {"section"}
+        assert SKIPPED_FAMILIES == {"generic"}
+        assert FALSE_POSITIVE_SIGS == {"creates_doc", "creates_hidden_file", "creates_exe", "creates_shortcut"}
+        assert SILENT_IOCS == {"creates_shortcut", "ransomware_mass_file_delete", "suspicious_process",
+                               "uses_windows_utilities", "creates_exe", "deletes_executed_files"}
 
     @staticmethod
     @pytest.mark.parametrize("api_report, file_ext, random_ip_range, correct_body",
@@ -1944,6 +2256,8 @@ class TestCuckooResult:
             ({"errors": [], "log": ["blah"], "cuckoo": []}, None),
             ({"errors": [], "log": ["ERROR: blah"], "cuckoo": []}, "blah"),
             ({"errors": [], "log": ["ERROR: blah", "ERROR: blah\n"], "cuckoo": []}, "blah\nblah"),
+            ({"errors": [], "log": ["ERROR:"], "cuckoo": []}, None),
+            ({"errors": [], "log": ["ERROR:\n", "ERROR: blah"], "cuckoo": []}, "blah"),
             ({"errors": [], "log": [], "cuckoo": ["blah"]}, None),
             ({"errors": [], "log": [], "cuckoo": ["blah", "\n"]}, "blah"),
             ({"errors": [], "log": [], "cuckoo": ["blah", "\n", "ERROR: blah"]}, "blah\nblah"),
@@ -3415,6 +3729,14 @@ class TestSafelist:
             'W3': f'https?://www\.w3\.org/.*',
         }
 
+    @staticmethod
+    def test_compiled_constants():
+        from cuckoo.safelist import SAFELIST_DROPPED, SAFELIST_HASHES, SAFELIST_DROPPED_SET, SAFELIST_HASHES_SET, \
+            SAFELIST_COMMON_REGEX, SAFELIST_COMMON_PATTERNS
+        assert SAFELIST_DROPPED_SET == frozenset(SAFELIST_DROPPED)
+        assert SAFELIST_HASHES_SET == frozenset(SAFELIST_HASHES)
+        assert SAFELIST_COMMON_REGEX.pattern == "|".join(f"(?:{pattern})" for pattern in SAFELIST_COMMON_PATTERNS.values())
+
     @staticmethod
     @pytest.mark.parametrize("data, sigs, correct_result",
         [